@@ -3,10 +3,13 @@ from libs.controllers.neighbours import NeighboursController
 from libs.controllers.config import ConfigController, NodeConfigData
 from libs.controllers.network import Frame
 from libs.controllers.measurement.Measurement import Measurement
-from libs.controllers.database.BinaryKV import BinarKVDatabase
+from libs.controllers.measurement.MeasurementBatcher import MeasurementBatcher
+from libs.controllers.measurement.MeasurementSchema import MeasurementSchema
 from libs.controllers.measurement import MeasurementController
 from libs.controllers.replication import ReplicationController
-from libs.controllers.database.CsvDatabase import CsvDatabase
+from libs.controllers.database.PartitionedDatabase import PartitionedDatabase
+from libs.controllers.database.ColumnarDatabase import ColumnarDatabase
+from libs.controllers.database.CompactionController import CompactionController
 from libs.controllers.network.routing import RoutingController
 from libs.controllers.network import INetworkController
 from libs.controllers.storage import IStorageController
@@ -22,7 +25,14 @@ class Node():
                  sensors: list[ISensor],
                  storage_controller: IStorageController,
                  network_controller: INetworkController,
-                 node_config: NodeConfigData) -> None:
+                 node_config: NodeConfigData,
+                 batch_measurements: bool = False,
+                 compact_measurements: bool = False) -> None:
+        """ when batch_measurements is set the measurements are broadcasted in
+            batches instead of a frame per measurement. when compact_measurements
+            is set the measurements are broadcasted without their keys, using the
+            schema in our config (see MeasurementSchema)
+        """
 
         self.sensors = sensors
 
@@ -48,26 +58,39 @@ class Node():
 
         # TODO: Fix this with a different method
         self.network_controller.routing_controller = self.routing_controller  # type: ignore
+        self.neighbours_controller.register_eviction_callback(self.routing_controller.handle_neighbour_lost)
 
         # setup measurement related controllers
         self.timekeeping_controller = RTCTimekeepingController()
+
+        self.compact_measurements = compact_measurements
+        self.measurement_schema = None
+
+        # a batch has to fit in a single frame
+        self.measurement_batcher = None
+        if batch_measurements:
+            self.measurement_batcher = MeasurementBatcher(
+                lambda batch: network_controller.send_message(Frame.FRAME_TYPES['measurement_batch'], batch),
+                max_size=(network_controller.max_frame_size or 200) - Frame.HEADER_SIZE
+            )
+
         self.measurement_controller = MeasurementController(
             sensors=self.sensors,
             timekeeping_controller=self.timekeeping_controller,
             actions=[
                 lambda m: logger((type(m), str(m)), channel='measurement'),  # log the measurement
                 lambda measurement: self.store_measurement(measurement),     # store the measurement
-                lambda measurement: network_controller.send_message(        # broadcast the measurement
-                    Frame.FRAME_TYPES['measurement'],
-                    measurement.encode()
-                )
+                lambda measurement: self.broadcast_measurement(measurement)  # broadcast the measurement
             ])
 
         self.replication_controller = ReplicationController(self.config_controller)
 
         filepath = '/sd/data.db'
-        self.database_controller = CsvDatabase(
-            filepath, self.storage_controller)
+        self.database_controller = PartitionedDatabase(
+            filepath, self.storage_controller, database=ColumnarDatabase,
+            aggregate_resolutions=(3600, 86400))  # hourly and daily aggregates
+        self.compaction_controller = CompactionController(
+            self.database_controller, self.timekeeping_controller)
 
         # register routing callbacks
         self.network_controller.register_callbacks({
@@ -80,6 +103,7 @@ class Node():
         self.network_controller.register_callbacks({
             Frame.FRAME_TYPES['config']: [self.config_controller.handle_message],
             Frame.FRAME_TYPES['measurement']: [self.store_measurement_frame],
+            Frame.FRAME_TYPES['measurement_batch']: [self.store_measurement_batch_frame],
             Frame.FRAME_TYPES['replication']: [self.replication_controller.handle_bid],
             Frame.FRAME_TYPES['discovery']: [lambda _: self.config_controller.broadcast_config()],
         })
@@ -88,6 +112,7 @@ class Node():
         self.network_controller.register_callbacks({
             Frame.FRAME_TYPES['routing_request']: [self.routing_controller.handle_routing_request],
             Frame.FRAME_TYPES['routing_response']: [self.routing_controller.handle_routing_response],
+            Frame.FRAME_TYPES['route_error']: [self.routing_controller.handle_route_error],
         })
 
         # extra callbacks
@@ -106,6 +131,10 @@ class Node():
         self.neighbours_controller.start()
         self.network_controller.start()
         self.routing_controller.start()
+        self.database_controller.start(60)  # sync the buffered measurements every minute
+        self.compaction_controller.start()
+        if self.measurement_batcher is not None:
+            self.measurement_batcher.start()
 
         logger('Node has been started. Broadcasting config', channel='info')
 
@@ -131,33 +160,99 @@ class Node():
             logger(f'\t {key}: {val}', channel='info')
 
     def print_message_received(self, frame: Frame):
+        if not logger.enabled('recieved_message'):
+            return
+
         logger(
             f'received a message of type {frame.type} from node {frame.source_address} for node {frame.destination_address}: {frame.data} (rssi: {frame.rssi})',
             channel='recieved_message'
         )
 
+    def encode_measurement(self, measurement: Measurement) -> bytes:
+        """ encode the measurement, compact when enabled and it fits a schema """
+        if not self.compact_measurements:
+            return measurement.encode()
+
+        encoded = None
+        if self.measurement_schema is not None:
+            encoded = self.measurement_schema.encode(measurement)
+
+        # the sensors changed, announce the new schema with our config
+        if encoded is None:
+            schema = MeasurementSchema.from_measurement(measurement)
+            if schema is None:
+                return measurement.encode()
+
+            self.measurement_schema = schema
+            self.config_controller.update_config('schema', schema.serialize())
+            encoded = schema.encode(measurement)
+
+        return encoded
+
+    def decode_measurement(self, address: int, data: bytes) -> Measurement | None:
+        """ decode a measurement of the node, None when we do not know its schema (yet) """
+        if not MeasurementSchema.is_compact(data):
+            return Measurement.decode(data)
+
+        schema = self.config_controller.ledger.schema(address)
+        if schema is None:
+            return None
+
+        return schema.decode(data)
+
+    def broadcast_measurement(self, measurement: Measurement):
+        encoded = self.encode_measurement(measurement)
+
+        if self.measurement_batcher is not None:
+            self.measurement_batcher.add(encoded)
+            return
+
+        self.network_controller.send_message(Frame.FRAME_TYPES['measurement'], encoded)
+
     def store_measurement_frame(self, frame: Frame):
+        self.handle_measurement(frame.source_address, frame.data, frame)
+
+    def store_measurement_batch_frame(self, frame: Frame):
+        # every measurement is of the source of the frame, once we asked for
+        # its config or bid on it the rest of the batch would do the same
+        for data in MeasurementBatcher.unpack(frame.data):
+            if not self.handle_measurement(frame.source_address, data, frame):
+                return
+
+    def handle_measurement(self, address: int, data: bytes, frame: Frame) -> bool:
+        """ store or bid on an encoded measurement of the node with the address, received in frame.
+            returns false when a discovery or bid was send instead of storing it
+        """
         # check if in ledger
-        if frame.source_address not in self.replication_controller.config_controller.ledger:
+        if address not in self.replication_controller.config_controller.ledger:
             # send a discovery message
             self.network_controller.send_message(
                 Frame.FRAME_TYPES['discovery'],
                 b'',
-                frame.source_address
+                address
             )
-            return
+            return False
 
         # check if we should store
-        if self.replication_controller.are_replicating(frame.source_address):
-            print('store measurement', frame.source_address)
-            measurement = Measurement.decode(frame.data)
-            return self.store_measurement(measurement, frame.source_address)
+        if self.replication_controller.are_replicating(address):
+            print('store measurement', address)
+            measurement = self.decode_measurement(address, data)
+
+            # the schema of the node is unknown or outdated, ask for its config
+            if measurement is None:
+                self.network_controller.send_message(Frame.FRAME_TYPES['discovery'], b'', address)
+                return False
 
-        # check if it needs new replications
-        if self.replication_controller.should_replicate(frame.source_address):
+            self.store_measurement(measurement, address)
+            return True
+
+        # check if it needs new replications, we bid with our distance to the node
+        if self.replication_controller.should_replicate(address):
             self.network_controller.send_message(
-                3, frame.ttl.to_bytes(4, 'big'), frame.source_address)
-            return
+                3, frame.distance.to_bytes(4, 'big'), address)
+            return False
+
+        return True
 
     def store_measurement(self, measurement: Measurement, address=None):
         # if no address is passed we will use our own
@@ -168,9 +263,14 @@ class Node():
         self.database_controller.store(measurement.timestamp, measurement.data)
 
     def __del__(self):
-        # stop all async tasks and threads
-        self.network_controller.stop()
+        # stop all async tasks and threads. the last batch is put in the send
+        # queue first, the network waits until the queue is send
+        if self.measurement_batcher is not None:
+            self.measurement_batcher.stop()
+        self.network_controller.stop(timeout=5)
         self.measurement_controller.stop()
+        self.database_controller.stop()
+        self.compaction_controller.stop()
 
         # close the database controller
         del self.database_controller
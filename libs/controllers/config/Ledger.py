@@ -1,3 +1,4 @@
+from libs.controllers.measurement.MeasurementSchema import MeasurementSchema
 from libs.controllers.config.NodeConfigData import NodeConfigData
 
 
@@ -9,9 +10,23 @@ class Ledger:
             ledger = {}
         self.ledger = ledger
 
+        # addr -> (schema in the config, parsed schema)
+        self.schemas: dict[int, tuple[list, MeasurementSchema]] = {}
+
     def get_node_config(self, addr):
         return self.ledger[addr]
 
+    def schema(self, addr) -> MeasurementSchema | None:
+        """ the measurement schema of a node, it is only parsed again when the config changed """
+        if addr not in self.ledger or self.ledger[addr].schema is None:
+            return None
+
+        fields = self.ledger[addr].schema
+        if addr not in self.schemas or self.schemas[addr][0] != fields:
+            self.schemas[addr] = (fields, MeasurementSchema.deserialize(fields))
+
+        return self.schemas[addr][1]
+
     def __getitem__(self, addr):
         return self.ledger[addr]
 
@@ -21,6 +21,9 @@ class NodeConfigData:
     ledger : dict
         a map of the configuration of the nodes in the network. the key is the address
         of the node and the value is the configuration of the node
+    schema : list | None
+        the fields the node measures as [name, scale] pairs (see MeasurementSchema),
+        None when the node sends its measurements with the keys
     """
 
     # network config
@@ -34,11 +37,12 @@ class NodeConfigData:
     replication_count: int  # 2 bytes unsigned
 
     def __init__(self, addr: int, measurement_interval: int, replication_count, replications=None,
-                 bidding_wait=1) -> None:
+                 bidding_wait=1, schema=None) -> None:
         self.addr = addr
         self.measurement_interval = measurement_interval
         self.replication_count = replication_count
         self.bidding_wait = bidding_wait
+        self.schema = schema
 
         if replications is None:
             replications = {}
@@ -51,7 +55,8 @@ class NodeConfigData:
             'measurement_interval': self.measurement_interval,
             'replication_count': self.replication_count,
             'replications': self.replications,
-            'bidding_wait': self.bidding_wait
+            'bidding_wait': self.bidding_wait,
+            'schema': self.schema
         })
 
     @staticmethod
@@ -0,0 +1,184 @@
+class Aggregate:
+    """
+        the count, sum, minimum and maximum of the numeric fields of a set of rows.
+
+        raw rows are added with their values, rollup rows (made by `row`) are
+        merged using their `<key>.count`, `<key>.mean`, `<key>.min` and
+        `<key>.max` fields. this way a rollup can be rolled up again into a
+        bigger bucket without losing the mean.
+    """
+
+    STATISTICS = ('count', 'mean', 'min', 'max')
+
+    def __init__(self, exclude=('address', 'until')):
+        self.exclude = exclude
+
+        # key -> [count, sum, min, max]
+        self.fields: dict[str, list] = {}
+
+    def add(self, key: str, count: int, total, low, high):
+        if key not in self.fields:
+            self.fields[key] = [count, total, low, high]
+            return
+
+        field = self.fields[key]
+        field[0] += count
+        field[1] += total
+        if low < field[2]:
+            field[2] = low
+        if high > field[3]:
+            field[3] = high
+
+    def add_row(self, data: dict):
+        """ add a raw row or a rollup row """
+        for key, value in data.items():
+            if key in self.exclude or type(value) not in (int, float):
+                continue
+
+            name, _, statistic = key.rpartition('.')
+            if not name:
+                self.add(key, 1, value, value, value)
+            elif statistic == 'count':
+                self.add(name, value, data[name + '.mean'] * value, data[name + '.min'], data[name + '.max'])
+
+    def row(self) -> dict:
+        """ the aggregate as a flat rollup row """
+        row = {}
+        for key, (count, total, low, high) in self.fields.items():
+            row[key + '.count'] = count
+            row[key + '.mean'] = total / count
+            row[key + '.min'] = low
+            row[key + '.max'] = high
+
+        return row
+
+    def __len__(self):
+        return len(self.fields)
+
+
+class AggregateIndex:
+    """
+        per node aggregates of fixed size time buckets, maintained on insert.
+
+        for every resolution (in seconds) the bucket the last row fell in is
+        kept in memory. when a row for another bucket arrives the bucket is
+        closed and stored as a rollup row (see Aggregate.row) in the rollups
+        of the PartitionedDatabase. an aggregate over a time range then only
+        reads one row per bucket instead of every raw row.
+
+        every rollup row has the timestamp of the last raw row in it as
+        `until`. `close` stores the open buckets as well. on the first row of
+        a node after a start the raw rows after the `until` of the last rollup
+        row of every resolution are read once: the buckets they close are
+        stored and the open buckets are rebuilt from the rest. a restart
+        therefore never loses the rows of a bucket that was still open.
+
+        a row that arrives late for a bucket that was already closed is stored
+        as an extra row for that bucket, as are the rows that arrive for a
+        bucket after it was stored by `close`. `aggregate` merges them.
+    """
+
+    def __init__(self, database, resolutions: list[int]):
+        self.database = database
+        self.resolutions = sorted(resolutions)
+
+        # (address, resolution) -> [bucket, Aggregate, timestamp of the last row in it]
+        self.open: dict[tuple[int, int], list] = {}
+
+    def add(self, address: int, timestamp: int, data: dict):
+        """ add a row, this should be called before the row is stored """
+        if not self.resolutions:
+            return
+
+        if (address, self.resolutions[0]) not in self.open:
+            self._recover(address, timestamp)
+
+        for resolution in self.resolutions:
+            self._add(address, resolution, timestamp, data)
+
+    def _add(self, address: int, resolution: int, timestamp: int, data: dict):
+        bucket = timestamp - timestamp % resolution
+        current = self.open.get((address, resolution))
+
+        if current is None or current[0] != bucket:
+            if current is not None:
+                self._store(address, resolution, current)
+
+            current = [bucket, Aggregate(), timestamp]
+            self.open[(address, resolution)] = current
+
+        current[1].add_row(data)
+        if timestamp > current[2]:
+            current[2] = timestamp
+
+    def _recover(self, address: int, timestamp: int):
+        """ add the rows stored before timestamp that are not in a rollup yet """
+        untils = {resolution: self._until(address, resolution) for resolution in self.resolutions}
+
+        start = None
+        if None not in untils.values():
+            start = min(untils.values()) + 1
+
+        for ts, data in self.database.partition(address).iter_range(start, timestamp - 1):
+            for resolution, until in untils.items():
+                if until is None or ts > until:
+                    self._add(address, resolution, ts, data)
+
+    def _until(self, address: int, resolution: int) -> int | None:
+        """ the timestamp of the last raw row in the rollups of the resolution, None when there are none """
+        rollup = self.database.rollup(address, resolution)
+        last = rollup.last_timestamp()
+        if last is None:
+            return None
+
+        until = None
+        for _, row in rollup.iter_range(last, last):
+            # a row without it is a closed bucket
+            row_until = row.get('until', last + resolution - 1)
+            if until is None or row_until > until:
+                until = row_until
+
+        return until
+
+    def _store(self, address: int, resolution: int, current: list):
+        bucket, aggregate, until = current
+        if len(aggregate) == 0:
+            return
+
+        row = aggregate.row()
+        row['address'] = address
+        row['until'] = until
+        self.database.rollup(address, resolution).store(bucket, row)
+
+    def close(self):
+        """ store the open buckets """
+        for (address, resolution), current in self.open.items():
+            self._store(address, resolution, current)
+
+        self.open = {}
+
+    def drop(self, address: int):
+        """ forget the open buckets of the address """
+        for resolution in self.resolutions:
+            self.open.pop((address, resolution), None)
+
+    def iter_buckets(self, address: int, start: int, end: int, resolution: int):
+        """ iterate over the buckets that overlap with [start, end] as [bucket, rollup row] """
+        if resolution not in self.resolutions:
+            raise ValueError(f'no aggregates with a resolution of {resolution} seconds')
+
+        yield from self.database.rollup(address, resolution).iter_range(start - start % resolution, end)
+
+        current = self.open.get((address, resolution))
+        if current is not None and start - start % resolution <= current[0] <= end and len(current[1]) > 0:
+            yield [current[0], current[1].row()]
+
+    def aggregate(self, address: int, start: int, end: int, resolution: int) -> dict:
+        """ the aggregate of all buckets that overlap with [start, end] as a rollup row.
+            the buckets on the edges are counted completely
+        """
+        aggregate = Aggregate()
+        for _, row in self.iter_buckets(address, start, end, resolution):
+            aggregate.add_row(row)
+
+        return aggregate.row()
@@ -1,3 +1,4 @@
+from libs.controllers.database.BufferedWriter import BufferedWriter, record_marker
 from libs.controllers.storage.LocalStorage import LocalStorageController
 from libs.controllers.database import IDatabaseController
 from libs.controllers.storage import IStorageController
@@ -5,6 +6,8 @@ from libs.external.ChannelLogger import logger
 
 import libs.external.umsgpack as umsgpack
 
+from binascii import crc32
+
 class BinarKVDatabase(IDatabaseController):
     """ 
         store the data in a binary format. 
@@ -23,32 +26,153 @@ class BinarKVDatabase(IDatabaseController):
             - the entire file has to be read to get the data 
 
             - if compression is wanted the entire file needs to be insert or read measuremnts
+
+        the records are written in batches, every batch is closed with a record
+        with a length of 0 that holds the crc32 of the batch. after a sync the
+        offset after the last marker and the last timestamp are written to the
+        footer file (`<filename>.ftr`), followed by the crc32 of both.
+
+        on open only the batches after the offset in the footer are checked.
+        the first batch that is cut off or does not match its checksum is the
+        torn tail of a write that was interrupted, the file is truncated to the
+        end of the batch before it. when the file can not be truncated (on the
+        board) the next batches overwrite the torn bytes and nothing after the
+        end of the last good batch is read.
     """
 
-    def __init__(self, filename: str, storage_controller: IStorageController):
+    FOOTER_SIZE = 12
+
+    def __init__(self, filename: str, storage_controller: IStorageController, max_bytes=512, max_delay=60):
         self.storage_controller = storage_controller
         self.filename = filename
 
-        # ensure the file exists and open it
+        # ensure the file exists and open it, without append mode so the torn tail can be overwritten
         self.storage_controller.ensure_exists(self.filename)
-        self.handle = open(filename, 'a+b')
+        self.handle = open(filename, 'r+b')
+
+        self.handle.seek(0, 2)
+        size = self.handle.tell()
+
+        # only check the batches written after the last footer
+        footer_offset, self.last_timestamp = self._load_footer()
+        if footer_offset > size:
+            footer_offset, self.last_timestamp = 0, 0
+
+        good, self.last_timestamp = self._recover(footer_offset, self.last_timestamp, size)
+        if good < size:
+            logger(f'{self.filename} has a torn tail after {good}, {size - good} bytes are discarded',
+                   channel='warning')
+            self._truncate(good)
+
+        # batch the records, every batch is closed with a record with a length of 0
+        self.writer = BufferedWriter(self.handle, good, max_bytes, max_delay, record_marker)
+
+        self.footer_offset = footer_offset
+        if good != footer_offset:
+            self._write_footer()
+
+    def _footer_path(self) -> str:
+        return f'{self.filename}.ftr'
+
+    def _load_footer(self) -> tuple[int, int]:
+        """ the last good offset and timestamp in the footer, (0, 0) when it is missing or torn """
+        try:
+            with open(self._footer_path(), 'rb') as f:
+                footer = f.read(self.FOOTER_SIZE)
+        except OSError:
+            return 0, 0
+
+        if len(footer) < self.FOOTER_SIZE or crc32(footer[0:8]) != int.from_bytes(footer[8:12], 'big'):
+            return 0, 0
+
+        return int.from_bytes(footer[0:4], 'big'), int.from_bytes(footer[4:8], 'big')
+
+    def _write_footer(self):
+        footer = self.writer.position.to_bytes(4, 'big') + self.last_timestamp.to_bytes(4, 'big')
+        with open(self._footer_path(), 'wb') as f:
+            f.write(footer + crc32(footer).to_bytes(4, 'big'))
+
+        self.footer_offset = self.writer.position
+
+    def _recover(self, position: int, last_timestamp: int, size: int) -> tuple[int, int]:
+        """ check the batches from position to the end of the file, returns the
+            offset after the last good batch and the last timestamp in it
+        """
+        good = position
+        crc = 0
+        records = 0
+        timestamp = last_timestamp
+
+        header = bytearray(8)
+        buffer = bytearray(0)
+
+        self.handle.seek(position)
+        while position + 8 <= size:
+            self.handle.readinto(header)
+            length = int.from_bytes(header[0:4], 'big')
+            ts = int.from_bytes(header[4:8], 'big')
+            position += 8
+
+            # a marker closes a batch of at least one record and holds its checksum
+            if length == 0:
+                if records == 0 or ts != crc:
+                    break
+
+                good, last_timestamp = position, timestamp
+                crc = 0
+                records = 0
+                continue
+
+            # the length of a torn record can point past the end of the file
+            if position + length > size:
+                break
+
+            if length > len(buffer):
+                buffer = bytearray(length)
+            view = memoryview(buffer)[:length]
+            self.handle.readinto(view)
+
+            crc = crc32(view, crc32(header, crc))
+            records += 1
+            timestamp = ts
+            position += length
+
+        return good, last_timestamp
+
+    def _truncate(self, size: int):
+        """ cut the file at size, when the port has no truncate the bytes are left to be overwritten """
+        if hasattr(self.handle, 'truncate'):
+            self.handle.truncate(size)
 
     def store(self, timestamp, data):
         """ store the data in a binary format. the first 32 bits are the timestamp, the rest is the data"""
         binary = umsgpack.dumps((timestamp, data))
 
         # encoded "total length of the data" + "timestamp" + "data"
-        self.handle.write(len(binary).to_bytes(4, 'big') + timestamp.to_bytes(4, 'big') + binary)
-        self.handle.flush()
+        self.writer.write(len(binary).to_bytes(4, 'big') + timestamp.to_bytes(4, 'big') + binary)
+        self.last_timestamp = timestamp
+
+        if self.writer.due():
+            self.writer.commit()
+
+    def sync(self):
+        """ commit the buffered records and move the footer to the end of them """
+        self.writer.commit()
+
+        if self.writer.position != self.footer_offset:
+            self._write_footer()
 
     def get(self, timestamp):
+        self.writer.commit()
         self.handle.seek(0)
 
-        # read only the bytes we need 
-        while True:
+        # read only the bytes we need, the bytes after the last good batch can be torn
+        while self.handle.tell() + 8 <= self.writer.position:
             line = self.handle.read(8)
-            if not line:
-                break
+
+            # skip the commit markers
+            if line[0:4] == b'\x00\x00\x00\x00':
+                continue
 
             ts = int.from_bytes(line[4:8], 'big')
             if ts == timestamp:
@@ -60,83 +184,63 @@ class BinarKVDatabase(IDatabaseController):
 
         return None
 
-    def get_all(self):
-        self.handle.seek(0)
-        data = []
+    def iter_range(self, start=None, end=None, fields=None):
+        """ iterate over the records with a timestamp in [start, end]. the data of
+            a record is read into a buffer that is reused for the whole iteration
+        """
+        self.writer.commit()
 
-        while True:
-            line = self.handle.read(8)
-            if not line:
-                break
+        header = bytearray(8)
+        buffer = bytearray(0)
+        position = 0
 
-            d = self.handle.read(int.from_bytes(line[0:4], 'big'))
-            data.append(umsgpack.loads(d))
+        # the bytes after the last good batch can be torn
+        while position + 8 <= self.writer.position:
+            # seek every record, other code can use the handle between two records
+            self.handle.seek(position)
+            self.handle.readinto(header)
 
-        return data
+            length = int.from_bytes(header[0:4], 'big')
+            ts = int.from_bytes(header[4:8], 'big')
+            position += 8 + length
 
-    # FIXME:: FIX THESE FUNCTIONS 
-    def get_all_between(self, start, end, inclusive=False):
-        """ FUNCTION WILL ONLY RETURN ERROR """
-        self.handle.seek(0)
-        data = []
-        while True:
-            line = self.handle.read(8)
-            if not line:
-                break
+            # skip the commit markers and the records outside of the range
+            if length == 0 or (start is not None and ts < start) or (end is not None and ts > end):
+                continue
 
-            ts = int.from_bytes(line[4:8], 'big')
-            if ts > start and ts < end or (inclusive and (ts == start or ts == end)):
-                d = self.handle.read(int.from_bytes(line[0:4], 'big'))
-                data.append(umsgpack.loads(d))
+            if length > len(buffer):
+                buffer = bytearray(length)
+            view = memoryview(buffer)[:length]
+            self.handle.readinto(view)
 
-            else:
-                # move to the next line
-                self.handle.seek(int.from_bytes(line[0:4], 'big'), 1)
+            record = umsgpack.loads(bytes(view))
+            if fields is not None:
+                record[1] = {key: value for key, value in record[1].items() if key in fields}
 
-        return data
+            yield record
 
-    def get_all_after(self, timestamp, inclusive=False):
-        """ FUNCTION WILL ONLY RETURN ERROR """
-        self.handle.seek(0)
-        data = []
+    def get_all(self):
+        return list(self.iter_range())
 
-        while True:
-            line = self.handle.read(8)
-            if not line:
-                break
+    def get_all_between(self, start, end, inclusive=False):
+        if not inclusive:
+            start, end = start + 1, end - 1
 
-            ts = int.from_bytes(line[4:8], 'big')
-            if ts > timestamp or (inclusive and ts == timestamp):
-                d = self.handle.read(int.from_bytes(line[0:4], 'big'))
-                data.append(umsgpack.loads(d))
+        return list(self.iter_range(start, end))
 
-            else:
-                # move to the next line
-                self.handle.seek(int.from_bytes(line[0:4], 'big'), 1)
+    def get_all_after(self, timestamp, inclusive=False):
+        if not inclusive:
+            timestamp += 1
 
-        return data
+        return list(self.iter_range(start=timestamp))
 
     def get_all_before(self, timestamp, inclusive=False):
-        """ FUNCTION WILL ONLY RETURN ERROR """
-        self.handle.seek(0)
-        data = []
-
-        while True:
-            line = self.handle.read(8)
-            if not line:
-                break
-
-            ts = int.from_bytes(line[4:8], 'big')
-            if ts < timestamp or (inclusive and ts == timestamp):
-                d = self.handle.read(int.from_bytes(line[0:4], 'big'))
-                data.append(umsgpack.loads(d))
+        if not inclusive:
+            timestamp -= 1
 
-            else:
-                # move to the next line
-                self.handle.seek(int.from_bytes(line[0:4], 'big'), 1)
+        return list(self.iter_range(end=timestamp))
 
-        return data
-    
     def __del__(self):
+        self.sync()
         self.handle.close()
         
\ No newline at end of file
@@ -0,0 +1,107 @@
+from binascii import crc32
+from time import time
+
+
+def record_marker(batch) -> bytes:
+    """ the commit marker for the length prefixed record format.
+
+        it is a record with a length of 0, the timestamp holds the crc32 of
+        the batch it closes. readers skip records with a length of 0.
+    """
+    return (0).to_bytes(4, 'big') + crc32(batch).to_bytes(4, 'big')
+
+
+class BufferedWriter:
+    """
+        collect writes in RAM and commit them to the file as a single batch.
+
+        every write to the SD card rewrites at least one 512 byte block, so
+        flushing every record costs a block write per measurement. the writer
+        keeps the records in a buffer until it holds `max_bytes` bytes or the
+        oldest buffered record is `max_delay` seconds old. the owner checks
+        `due` after a write and calls `commit`, or calls `commit` directly to
+        sync. `max_delay` is the window in which records can be lost on a power
+        failure.
+
+        when a `marker` function is given its result is written directly after
+        every batch. on reopen everything after the last marker is a torn batch.
+        `mark` ends a batch in the buffer without committing it, so the owner
+        can make sure a batch never spans two of its own units (like blocks).
+    """
+
+    def __init__(self, handle, position: int = 0, max_bytes: int = 512, max_delay: int = 10, marker=None):
+        self.handle = handle
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.marker = marker
+
+        # the amount of bytes in the file
+        self.position = position
+
+        self.buffer = bytearray()
+        self.first_write = None
+
+        # the start of the batch in the buffer that is not marked yet
+        self.batch_start = 0
+
+    @property
+    def size(self) -> int:
+        """ the size of the file once the buffer is committed, without the marker """
+        return self.position + len(self.buffer)
+
+    def write(self, data: bytes):
+        if self.first_write is None:
+            self.first_write = time()
+
+        self.buffer.extend(data)
+
+    def due(self) -> bool:
+        """ check if the buffer should be committed """
+        if not self.buffer:
+            return False
+
+        return len(self.buffer) >= self.max_bytes or time() - self.first_write >= self.max_delay
+
+    def mark(self):
+        """ end the current batch with a marker, without committing it """
+        if self.marker is None or len(self.buffer) == self.batch_start:
+            return
+
+        self.buffer.extend(self.marker(memoryview(self.buffer)[self.batch_start:]))
+        self.batch_start = len(self.buffer)
+
+    def commit(self) -> int:
+        """ write the buffer and the marker to the file, returns the amount of bytes written """
+        if not self.buffer:
+            return 0
+
+        self.mark()
+
+        self.handle.seek(self.position)
+        self.handle.write(self.buffer)
+        self.handle.flush()
+
+        written = len(self.buffer)
+        self.position += written
+        self.buffer = bytearray()
+        self.first_write = None
+        self.batch_start = 0
+
+        return written
+
+    def readinto(self, offset: int, buffer):
+        """ read len(buffer) bytes at offset into buffer, from the file and the part
+            of the buffer that is not committed yet
+        """
+        length = len(buffer)
+        view = memoryview(buffer)
+
+        read = 0
+        if offset < self.position:
+            read = min(length, self.position - offset)
+            self.handle.seek(offset)
+            self.handle.readinto(view[:read])
+
+        if read < length:
+            start = offset + read - self.position
+            view[read:] = self.buffer[start:start + length - read]
@@ -0,0 +1,218 @@
+"""
+    the encoding of the columns of the blocks of the ColumnarDatabase.
+
+    kept apart from the database so the blocks can also be read on a computer,
+    see MappedReader.
+"""
+import libs.external.umsgpack as umsgpack
+
+import struct
+
+
+COLUMN_INT = ord('i')
+COLUMN_FLOAT = ord('f')
+COLUMN_MSGPACK = ord('m')
+COLUMN_DECIMAL = ord('d')
+
+# the most decimals a float column is stored as scaled integers with
+MAX_DECIMALS = 6
+
+
+def write_varint(buffer: bytearray, value: int):
+    """ append an unsigned LEB128 varint """
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data, position: int) -> tuple[int, int]:
+    """ read an unsigned LEB128 varint, returns the value and the new position """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode_ints(values) -> bytearray:
+    """ zigzag varints of the difference with the previous value """
+    buffer = bytearray()
+    previous = 0
+    for value in values:
+        write_varint(buffer, zigzag(value - previous))
+        previous = value
+
+    return buffer
+
+
+def decode_ints(data, rows: int) -> list:
+    values = []
+    previous = 0
+    position = 0
+    for _ in range(rows):
+        delta, position = read_varint(data, position)
+        previous += unzigzag(delta)
+        values.append(previous)
+
+    return values
+
+
+def encode_floats(values) -> bytearray:
+    """ xor of the bits of the double with the previous value.
+
+        every value starts with a byte with the amount of trailing zero bytes
+        of the xor in the upper nibble and the amount of remaining bytes in the
+        lower nibble, followed by the remaining bytes. an unchanged value is a
+        single zero byte.
+    """
+    buffer = bytearray()
+    previous = 0
+    for value in values:
+        bits = struct.unpack('>Q', struct.pack('>d', value))[0]
+        xor = bits ^ previous
+        previous = bits
+
+        if xor == 0:
+            buffer.append(0)
+            continue
+
+        trailing = 0
+        while not xor & 0xff:
+            xor >>= 8
+            trailing += 1
+
+        length = 0
+        remaining = xor
+        while remaining:
+            remaining >>= 8
+            length += 1
+
+        buffer.append(trailing << 4 | length)
+        buffer.extend(xor.to_bytes(length, 'big'))
+
+    return buffer
+
+
+def decode_floats(data, rows: int) -> list:
+    values = []
+    previous = 0
+    position = 0
+    for _ in range(rows):
+        header = data[position]
+        position += 1
+
+        if header:
+            length = header & 0x0f
+            xor = int.from_bytes(data[position:position + length], 'big') << ((header >> 4) * 8)
+            position += length
+            previous ^= xor
+
+        values.append(struct.unpack('>d', struct.pack('>Q', previous))[0])
+
+    return values
+
+
+def decimals(values) -> int | None:
+    """ the lowest amount of decimals all values are written with, None when
+        there are more than MAX_DECIMALS or a value is not finite
+    """
+    for exponent in range(MAX_DECIMALS + 1):
+        scale = 10 ** exponent
+        try:
+            # the same division as decode_decimals, so the values are read back exactly
+            if all(abs(round(value * scale)) < 1 << 53 and round(value * scale) / scale == value
+                   for value in values):
+                return exponent
+        except (ValueError, OverflowError):
+            return None
+
+    return None
+
+
+def encode_decimals(values, exponent: int) -> bytearray:
+    """ a byte with the exponent, followed by the values times 10 ** exponent
+        as integers, see `encode_ints`. a reading like 20.5 then mostly takes a
+        single byte instead of the bytes of the xor of its double
+    """
+    scale = 10 ** exponent
+    buffer = bytearray([exponent])
+    buffer.extend(encode_ints([round(value * scale) for value in values]))
+    return buffer
+
+
+def decode_decimals(data, rows: int) -> list:
+    scale = 10 ** data[0]
+    return [value / scale for value in decode_ints(data[1:], rows)]
+
+
+def decode_column(column_type: int, data, rows: int) -> list:
+    if column_type == COLUMN_INT:
+        return decode_ints(data, rows)
+
+    if column_type == COLUMN_DECIMAL:
+        return decode_decimals(data, rows)
+
+    if column_type == COLUMN_FLOAT:
+        return decode_floats(data, rows)
+
+    return umsgpack.loads(bytes(data))
+
+
+def read_schema(binary) -> tuple[int, list, int]:
+    """ read the header of a block written by the ColumnarDatabase.
+
+        returns the amount of rows, the [key, type, offset, length] of every
+        column and the position of the timestamps. the offsets of the columns
+        are only known after the timestamps, they are filled in by `read_block`
+    """
+    rows = int.from_bytes(binary[4:6], 'big')
+    column_count = binary[6]
+
+    schema = []
+    position = 7
+    for _ in range(column_count):
+        length = binary[position]
+        key = bytes(binary[position + 1:position + 1 + length]).decode()
+        position += 1 + length
+        schema.append([key, binary[position], 0, int.from_bytes(binary[position + 1:position + 3], 'big')])
+        position += 3
+
+    return rows, schema, position
+
+
+def read_block(timestamp: int, binary) -> tuple[list, list, int]:
+    """ read the schema and timestamps of a block written by the ColumnarDatabase.
+
+        returns the timestamps of the rows, the [key, type, offset, length] of
+        every column and the position after the columns
+    """
+    rows, schema, position = read_schema(binary)
+
+    timestamps = []
+    previous = timestamp
+    previous_delta = 0
+    for _ in range(rows):
+        dod, position = read_varint(binary, position)
+        previous_delta += unzigzag(dod)
+        previous += previous_delta
+        timestamps.append(previous)
+
+    # the columns follow the timestamps
+    for column in schema:
+        column[2] = position
+        position += column[3]
+
+    return timestamps, schema, position
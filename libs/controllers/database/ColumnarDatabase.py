@@ -0,0 +1,186 @@
+from libs.controllers.database.SegmentDatabase import SegmentDatabase
+from libs.controllers.storage import IStorageController
+
+from libs.controllers.database.ColumnCodec import (COLUMN_INT, COLUMN_FLOAT, COLUMN_MSGPACK, COLUMN_DECIMAL,
+                                                   write_varint, zigzag, encode_ints, encode_floats, encode_decimals,
+                                                   decimals, decode_column, read_block)
+
+import libs.external.umsgpack as umsgpack
+
+
+class ColumnarDatabase(SegmentDatabase):
+    """
+        store the data in columnar, delta encoded blocks.
+
+        the rows are buffered until `rows_per_block` rows with the same keys are
+        collected. they are then written as a single record of the segment
+        database, the timestamp of the record is the lowest timestamp in the block.
+        the data of the record has the following format:
+            - 4 bytes: highest timestamp in the block
+            - 2 bytes: amount of rows
+            - 1 byte: amount of columns
+            - the schema, for every column:
+                - 1 byte: length of the key
+                - the key
+                - 1 byte: type of the column, (i)nt, (d)ecimal, (f)loat or (m)sgpack
+                - 2 bytes: length of the encoded column
+            - the timestamps as zigzag varints of the delta-of-delta to the
+              previous timestamp, starting from the lowest timestamp
+            - the columns:
+                - int: zigzag varints of the delta to the previous value
+                - decimal: floats with at most `ColumnCodec.MAX_DECIMALS` decimals, a
+                  byte with the amount of decimals followed by the values
+                  times 10 to the power of it as an int column
+                - float: xor of the double with the previous value, see `ColumnCodec.encode_floats`
+                - msgpack: a msgpack list of the values
+
+        the keys are stored once per block instead of once per row and a
+        measurement taken at a fixed interval mostly takes a single byte per
+        column. because every column has its length in the schema a query only
+        decodes the columns it asks for.
+
+        the rows that do not fill a block yet are kept in memory and are only
+        written on `flush` or `sync`. a sync therefore can write a block that is
+        not full, a longer durability window gives fuller blocks.
+    """
+
+    BOUNDS_SIZE = 4
+
+    def __init__(self, filename: str, storage_controller: IStorageController,
+                 rows_per_block: int = 32, **segment_options):
+        self.rows_per_block = rows_per_block
+
+        # the rows that are not written yet and their keys
+        self.pending: list[tuple[int, dict]] = []
+        self.pending_keys = None
+
+        # every record already holds a block of rows, so index fewer records at once
+        if 'block_records' not in segment_options:
+            segment_options['block_records'] = 4
+
+        super().__init__(filename, storage_controller, **segment_options)
+
+    def store(self, timestamp, data):
+        keys = tuple(data.keys())
+        if self.pending and keys != self.pending_keys:
+            self.flush()
+
+        self.pending_keys = keys
+        self.pending.append((timestamp, data))
+
+        if len(self.pending) >= self.rows_per_block:
+            self.flush()
+
+    def flush(self):
+        """ write the pending rows as a block, even when it is not full """
+        if not self.pending:
+            return
+
+        # take the rows first, appending the block can trigger a sync
+        pending, keys = self.pending, self.pending_keys
+        self.pending = []
+        self.pending_keys = None
+
+        timestamps = [row[0] for row in pending]
+        low = min(timestamps)
+        high = max(timestamps)
+
+        # the timestamps as delta-of-delta
+        encoded_ts = bytearray()
+        previous = low
+        previous_delta = 0
+        for ts in timestamps:
+            delta = ts - previous
+            write_varint(encoded_ts, zigzag(delta - previous_delta))
+            previous = ts
+            previous_delta = delta
+
+        schema = bytearray()
+        columns = []
+        for key in keys:
+            values = [row[1][key] for row in pending]
+            column_type, encoded = self._encode_column(values)
+
+            name = key.encode()
+            schema.append(len(name))
+            schema.extend(name)
+            schema.append(column_type)
+            schema.extend(len(encoded).to_bytes(2, 'big'))
+            columns.append(encoded)
+
+        self._append(low, b''.join([
+            high.to_bytes(4, 'big'),
+            len(pending).to_bytes(2, 'big'),
+            len(columns).to_bytes(1, 'big'),
+            schema,
+            encoded_ts,
+        ] + columns), high)
+
+    @staticmethod
+    def _encode_column(values) -> tuple[int, bytes]:
+        """ pick the most compact encoding the values allow """
+        if all(type(value) is int for value in values):
+            return COLUMN_INT, encode_ints(values)
+
+        if all(type(value) in (int, float) for value in values):
+            exponent = decimals(values)
+            if exponent is not None:
+                return COLUMN_DECIMAL, encode_decimals(values, exponent)
+
+            return COLUMN_FLOAT, encode_floats(values)
+
+        return COLUMN_MSGPACK, umsgpack.dumps(values)
+
+    @staticmethod
+    def _decode_column(column_type: int, data, rows: int) -> list:
+        return decode_column(column_type, data, rows)
+
+    def _bounds(self, timestamp: int, prefix: bytes) -> tuple[int, int]:
+        return timestamp, int.from_bytes(prefix, 'big')
+
+    def _rows(self, timestamp: int, binary: bytes, start, end, fields):
+        high = int.from_bytes(binary[0:4], 'big')
+        if (start is not None and high < start) or (end is not None and timestamp > end):
+            return
+
+        timestamps, schema, _ = read_block(timestamp, binary)
+        rows = len(timestamps)
+
+        selected = [i for i, ts in enumerate(timestamps)
+                    if (start is None or ts >= start) and (end is None or ts <= end)]
+        if not selected:
+            return
+
+        # only decode the columns that are asked for
+        data = [{} for _ in selected]
+        for key, column_type, offset, length in schema:
+            if fields is None or key in fields:
+                values = self._decode_column(column_type, binary[offset:offset + length], rows)
+                for row, i in zip(data, selected):
+                    row[key] = values[i]
+
+        for row, i in zip(data, selected):
+            yield [timestamps[i], row]
+
+    def iter_range(self, start=None, end=None, fields=None):
+        yield from super().iter_range(start, end, fields)
+
+        # the pending rows are not written to the segment yet
+        for timestamp, row in self.pending:
+            if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                if fields is not None:
+                    row = {key: value for key, value in row.items() if key in fields}
+                yield [timestamp, row]
+
+    def last_timestamp(self) -> int | None:
+        last = super().last_timestamp()
+        for timestamp, _ in self.pending:
+            if last is None or timestamp > last:
+                last = timestamp
+
+        return last
+
+    def sync(self):
+        # the pending rows are part of the durability window as well
+        self.flush()
+        super().sync()
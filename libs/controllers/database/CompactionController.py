@@ -0,0 +1,152 @@
+from libs.controllers.database.PartitionedDatabase import PartitionedDatabase
+from libs.controllers.database.SegmentDatabase import SegmentDatabase
+from libs.controllers.timekeeping import ITimekeepingController
+from libs.controllers.database.Aggregate import Aggregate
+from libs.external.ChannelLogger import logger
+
+import asyncio
+
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+
+class RetentionPolicy:
+    """
+        the tiers data goes through as it gets older.
+
+        every tier is a tuple of the resolution in seconds, 0 being the raw
+        measurements, and the amount of seconds the data is kept at that
+        resolution, None being forever. once data is older it is rolled up into
+        the resolution of the next tier, the last tier is deleted instead.
+
+        by default the raw data is kept for 7 days, then 1 minute rollups for
+        90 days and hourly rollups forever.
+    """
+
+    def __init__(self, tiers: list[tuple[int, int | None]] | None = None) -> None:
+        if tiers is None:
+            tiers = [(0, 7 * DAY), (MINUTE, 90 * DAY), (HOUR, None)]
+
+        self.tiers = tiers
+
+
+class CompactionController:
+    """
+        roll old segments up into lower resolution segments.
+
+        on every run the closed segments of every node are checked against the
+        retention policy. a segment that is completely older than its tier is
+        rolled up into buckets of the next tier with the min, mean and max of
+        every numeric field (see Aggregate) and then deleted.
+
+        the segments are processed one at a time and control is given back to
+        the event loop every `rows_per_yield` rows, so measuring and receiving
+        continue while compacting. only closed segments are touched, the
+        segment that is being written to is never compacted.
+
+        a bucket that spans two segments ends up as two rollup rows. when the
+        resolution of the next tier is already maintained on insert by the
+        AggregateIndex of the database the old segments are only deleted.
+    """
+
+    def __init__(self, database: PartitionedDatabase, timekeeping_controller: ITimekeepingController,
+                 policy: RetentionPolicy | None = None, rows_per_yield: int = 32) -> None:
+        self.database = database
+        self.timekeeping_controller = timekeeping_controller
+        self.rows_per_yield = rows_per_yield
+
+        if policy is None:
+            policy = RetentionPolicy()
+        self.policy = policy
+
+    def start(self, period: int = HOUR):
+        loop = asyncio.get_event_loop()
+        self.task = loop.create_task(self._start(period))
+
+    def stop(self):
+        self.task.cancel()
+
+    async def _start(self, period: int = HOUR):
+        while True:
+            await asyncio.sleep(period)
+            await self.compact()
+
+    def _tier_database(self, address: int, resolution: int) -> SegmentDatabase:
+        if resolution == 0:
+            return self.database.partition(address)
+
+        return self.database.rollup(address, resolution)
+
+    async def compact(self):
+        """ apply the retention policy to the data of all nodes """
+        now = self.timekeeping_controller.get_time()
+        tiers = self.policy.tiers
+
+        for address in self.database.addresses():
+            for i, (resolution, keep) in enumerate(tiers):
+                if keep is None:
+                    break
+
+                source = self._tier_database(address, resolution)
+
+                # the last tier has nothing to roll up into
+                if i == len(tiers) - 1:
+                    await self._expire(source, now - keep)
+                    continue
+
+                target_resolution = tiers[i + 1][0]
+                if target_resolution in self.database.index.resolutions:
+                    await self._expire(source, now - keep)
+                    continue
+
+                await self._rollup(address, source, self._tier_database(address, target_resolution),
+                                   target_resolution, now - keep)
+
+    async def _expire(self, source: SegmentDatabase, cutoff: int):
+        """ delete the segments that are completely before the cutoff """
+        for segment, _, high in source.closed_segments():
+            if high < cutoff:
+                source.drop_segment(segment)
+                await asyncio.sleep(0)
+
+    async def _rollup(self, address: int, source: SegmentDatabase, target: SegmentDatabase,
+                      resolution: int, cutoff: int):
+        """ roll the segments that are completely before the cutoff up into the target """
+        for segment, _, high in source.closed_segments():
+            if high >= cutoff:
+                continue
+
+            bucket = None
+            aggregate = Aggregate()
+
+            for i, (timestamp, data) in enumerate(source.iter_segment(segment)):
+                start = timestamp - timestamp % resolution
+                if start != bucket:
+                    self._store(target, address, bucket, aggregate)
+                    bucket = start
+                    aggregate = Aggregate()
+
+                aggregate.add_row(data)
+
+                if i % self.rows_per_yield == self.rows_per_yield - 1:
+                    await asyncio.sleep(0)
+
+            self._store(target, address, bucket, aggregate)
+
+            # the raw rows can only go once their rollup is on the flash
+            target.sync()
+            source.drop_segment(segment)
+
+            logger(f'rolled up segment {segment} of node {address} into {resolution}s buckets',
+                   channel='info')
+
+    @staticmethod
+    def _store(target: SegmentDatabase, address: int, bucket, aggregate: Aggregate):
+        if bucket is None or len(aggregate) == 0:
+            return
+
+        row = aggregate.row()
+        row['address'] = address
+        target.store(bucket, row)
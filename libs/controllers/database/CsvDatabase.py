@@ -1,44 +1,244 @@
+from libs.controllers.database.BufferedWriter import BufferedWriter
 from libs.controllers.database import IDatabaseController
 from libs.controllers.storage import IStorageController
+from libs.external.ChannelLogger import logger
 
 
 class CsvDatabase(IDatabaseController):
+    """
+        store the data as `<timestamp>,<data>` lines.
 
-    def __init__(self, filename: str, storage_controller: IStorageController):
+        the lines are appended in time order. every `checkpoint_lines` lines the
+        timestamp and byte offset of the line are written to the side index
+        (`<filename>.idx`) as 2 times 4 bytes. a range query does a binary search
+        over the index file to seek to the last checkpoint before the start of
+        the range and stops reading at the first line after the end of it.
+
+        every line ends with a newline, so a line without one at the end of
+        the file is the torn tail of a write that was interrupted. on open it
+        is cut off, as are a torn entry at the end of the index file and the
+        checkpoints of lines that are not in the data file. the next lines are
+        written after the last whole line and the next checkpoints after the
+        last whole checkpoint, so when the port can not truncate they
+        overwrite the cut off bytes and nothing after them is read.
+    """
+
+    CHECKPOINT_SIZE = 8
+
+    def __init__(self, filename: str, storage_controller: IStorageController, max_bytes=512, max_delay=60,
+                 checkpoint_lines=64):
         self.storage_controller = storage_controller
         self.filename = filename
+        self.checkpoint_lines = checkpoint_lines
 
-        # ensure the file exists and open it
+        # ensure the file exists and open it, without append mode so the torn tail can be overwritten
         self.storage_controller.ensure_exists(self.filename)
-        self.handle = open(filename, 'a+')
+        self.handle = open(filename, 'r+b')
+
+        self.handle.seek(0, 2)
+        end = self.handle.tell()
+        size = self._last_line_end(end)
+        if size < end:
+            logger(f'{self.filename} has a torn line at {size}, {end - size} bytes are discarded', channel='warning')
+            self._truncate(self.handle, size)
+
+        self.writer = BufferedWriter(self.handle, size, max_bytes, max_delay)
+
+        # the checkpoints that are not committed yet
+        self.pending_checkpoints: list[tuple[int, int]] = []
+
+        # without append mode, so the cut off checkpoints can be overwritten
+        self.storage_controller.ensure_exists(self._index_path())
+        self.index_handle = open(self._index_path(), 'r+b')
+        self._load_index(size)
+
+        self._scan_tail()
+
+    def _index_path(self) -> str:
+        return f'{self.filename}.idx'
+
+    def _last_line_end(self, size: int) -> int:
+        """ the offset after the last newline in the first size bytes of the file """
+        chunk = 64
+        position = size
+        while position > 0:
+            start = max(0, position - chunk)
+            self.handle.seek(start)
+            data = self.handle.read(position - start)
+
+            newline = data.rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+
+            position = start
+
+        return 0
+
+    def _load_index(self, size: int):
+        """ count the whole checkpoints in the index that point to a line in the size bytes of the data file """
+        self.index_handle.seek(0, 2)
+        index_size = self.index_handle.tell()
+        self.index_count = index_size // self.CHECKPOINT_SIZE
+
+        # the checkpoints are in file order, the last ones can be past the end of the data
+        while self.index_count > 0 and self._checkpoint(self.index_count - 1)[1] >= size:
+            self.index_count -= 1
+
+        if self.index_count * self.CHECKPOINT_SIZE < index_size:
+            logger(f'{self._index_path()} has a torn or outdated tail, '
+                   f'{index_size - self.index_count * self.CHECKPOINT_SIZE} bytes are discarded', channel='warning')
+            self._truncate(self.index_handle, self.index_count * self.CHECKPOINT_SIZE)
+
+    @staticmethod
+    def _truncate(handle, size: int):
+        """ cut the file at size, when the port has no truncate the bytes are left to be overwritten """
+        if hasattr(handle, 'truncate'):
+            handle.truncate(size)
+
+    def _scan_tail(self):
+        """ count the lines after the last checkpoint, when the index is missing it is rebuilt """
+        if self.index_count > 0:
+            _, position = self._checkpoint(self.index_count - 1)
+            self.since_checkpoint = 0
+        else:
+            position = 0
+            self.since_checkpoint = self.checkpoint_lines
+
+        for offset, line in self._lines(position):
+            timestamp = self._timestamp(line)
+            if timestamp is not None:
+                self._account(timestamp, offset)
+
+        self.sync()
+
+    def _account(self, timestamp: int, offset: int):
+        """ account a line, every `checkpoint_lines` lines a checkpoint is added """
+        if self.since_checkpoint >= self.checkpoint_lines:
+            self.pending_checkpoints.append((timestamp, offset))
+            self.since_checkpoint = 0
+
+        self.since_checkpoint += 1
+
+    def _checkpoint(self, i: int) -> tuple[int, int]:
+        """ the timestamp and offset of a checkpoint, the pending checkpoints come after the index file """
+        if i >= self.index_count:
+            return self.pending_checkpoints[i - self.index_count]
+
+        self.index_handle.seek(i * self.CHECKPOINT_SIZE)
+        entry = self.index_handle.read(self.CHECKPOINT_SIZE)
+        return int.from_bytes(entry[0:4], 'big'), int.from_bytes(entry[4:8], 'big')
+
+    def _seek_position(self, timestamp: int) -> int:
+        """ binary search for the offset of the last checkpoint before timestamp """
+        low, high = 0, self.index_count + len(self.pending_checkpoints)
+        while low < high:
+            middle = (low + high) // 2
+            if self._checkpoint(middle)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == 0:
+            return 0
+
+        return self._checkpoint(low - 1)[1]
 
     def store(self, timestamp, data):
-        self.handle.write(f'{timestamp},{data}\n')
-        self.handle.flush()
+        self._account(timestamp, self.writer.size)
+
+        self.writer.write(f'{timestamp},{data}\n'.encode())
+        if self.writer.due():
+            self.sync()
+
+    def sync(self):
+        """ commit the buffered lines, followed by the checkpoints in them """
+        self.writer.commit()
+
+        if self.pending_checkpoints:
+            self.index_handle.seek(self.index_count * self.CHECKPOINT_SIZE)
+            self.index_handle.write(b''.join([
+                timestamp.to_bytes(4, 'big') + offset.to_bytes(4, 'big')
+                for timestamp, offset in self.pending_checkpoints
+            ]))
+            self.index_handle.flush()
+
+            self.index_count += len(self.pending_checkpoints)
+            self.pending_checkpoints = []
+
+    def _lines(self, position=0):
+        """ iterate over the offset and line of the lines starting at position, one line at a time """
+        self.writer.commit()
+
+        # the bytes after the committed lines are a torn tail that was not overwritten yet
+        while position < self.writer.position:
+            # seek every line, other code can use the handle between two lines
+            self.handle.seek(position)
+            line = self.handle.readline()
+            if not line:
+                break
+
+            yield position, line.decode()
+            position += len(line)
+
+    @staticmethod
+    def _timestamp(line: str):
+        """ the timestamp of the line, None for a torn or empty line """
+        try:
+            return int(line[:line.find(',')])
+        except ValueError:
+            return None
+
+    def _range(self, start=None, end=None):
+        """ iterate over the lines with a timestamp in [start, end] """
+        position = 0 if start is None else self._seek_position(start)
+
+        for _, line in self._lines(position):
+            timestamp = self._timestamp(line)
+            if timestamp is None:
+                continue
+
+            # the lines are in time order, nothing after this is in the range
+            if end is not None and timestamp > end:
+                break
+
+            if start is None or timestamp >= start:
+                yield timestamp, line
+
+    def iter_range(self, start=None, end=None, fields=None):
+        """ iterate over the lines with a timestamp in [start, end] as [timestamp, data].
+            the data is stored as text, so fields is not supported
+        """
+        for timestamp, line in self._range(start, end):
+            yield [timestamp, line.rstrip('\n').split(',', 1)[1]]
 
     def get(self, timestamp):
-        self.handle.seek(0)
-        for line in self.handle.readlines():
-            if line.startswith(str(timestamp)):
-                return line.split(',')[1]
+        for _, data in self.iter_range(timestamp, timestamp):
+            return data
 
         return None
 
     def get_all(self):
-        self.handle.seek(0)
-        return self.handle.readlines()
+        return [line for _, line in self._lines()]
+
+    def get_all_between(self, start, end, inclusive=False):
+        if not inclusive:
+            start, end = start + 1, end - 1
+
+        return [line for _, line in self._range(start, end)]
+
+    def get_all_after(self, timestamp, inclusive=False):
+        if not inclusive:
+            timestamp += 1
 
-    def get_all_between(self, start, end):
-        self.handle.seek(0)
-        return [line for line in self.handle.readlines() if line.startswith(str(start)) and line.startswith(str(end))]
+        return [line for _, line in self._range(start=timestamp)]
 
-    def get_all_after(self, timestamp):
-        self.handle.seek(0)
-        return [line for line in self.handle.readlines() if line.startswith(str(timestamp))]
+    def get_all_before(self, timestamp, inclusive=False):
+        if not inclusive:
+            timestamp -= 1
 
-    def get_all_before(self, timestamp):
-        self.handle.seek(0)
-        return [line for line in self.handle.readlines() if line.startswith(str(timestamp))]
+        return [line for _, line in self._range(end=timestamp)]
 
     def __del__(self):
-        self.handle.close()
\ No newline at end of file
+        self.sync()
+        self.handle.close()
+        self.index_handle.close()
@@ -0,0 +1,338 @@
+from libs.controllers.database.ColumnCodec import (COLUMN_INT, COLUMN_FLOAT, COLUMN_DECIMAL, decode_column, read_block,
+                                                   read_schema)
+
+import libs.external.umsgpack as umsgpack
+
+from binascii import crc32
+import struct
+import mmap
+
+
+class MappedReader:
+    """
+        read a database file copied off a node on the host, without copying it.
+
+        the file is memory-mapped and the record headers are walked with
+        `struct.unpack_from`, the data of a record is only decoded when it is
+        used. it reads the length prefixed records of the BinarKVDatabase and
+        the segments of the SegmentDatabase and ColumnarDatabase:
+            - 4 bytes: total length of the data
+            - 4 bytes: timestamp
+            - the rest: the data, a msgpack [timestamp, data] or a columnar block
+
+        the format is detected from the first record, or given as `MSGPACK` or
+        `COLUMNAR`. a record of a columnar file is a block of rows, `len`,
+        iterating and `record` work on rows in both formats.
+
+        like the recovery on the board, only the batches that end with a commit
+        marker matching their crc32 are read. the first torn batch ends the file.
+
+        this is for the analysis on a computer, mmap is not available on the
+        board. `to_numpy` needs numpy, which is only imported when it is used.
+        when the msgpack package is installed it is used to decode the records,
+        it is a lot faster than umsgpack.
+    """
+
+    HEADER = struct.Struct('>II')
+
+    MSGPACK = 'msgpack'
+    COLUMNAR = 'columnar'
+
+    def __init__(self, filename: str, format: str | None = None):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+
+        # an empty file can not be mapped
+        if self.file.seek(0, 2) == 0:
+            self.map = b''
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        # (offset of the data, length of the data, timestamp), built when it is first needed
+        self._index: list[tuple[int, int, int]] | None = None
+        self._format = format
+
+        # the index of the first row of every block of a columnar file
+        self._first_rows: list[int] | None = None
+
+        try:
+            import msgpack
+            self._loads = lambda data: msgpack.unpackb(data, strict_map_key=False)
+        except ImportError:
+            self._loads = lambda data: umsgpack.loads(bytes(data))
+
+    @property
+    def index(self) -> list[tuple[int, int, int]]:
+        """ the offset, length and timestamp of the data of every committed record """
+        if self._index is None:
+            self._index = list(self._walk())
+
+        return self._index
+
+    def _walk(self):
+        size = len(self.view)
+        position = 0
+
+        # the records after the last marker and the crc32 of their bytes
+        batch = []
+        crc = 0
+
+        while position + self.HEADER.size <= size:
+            length, timestamp = self.HEADER.unpack_from(self.view, position)
+            header = self.view[position:position + self.HEADER.size]
+            position += self.HEADER.size
+
+            # a marker, the batch is only read when it matches its crc
+            if length == 0:
+                if not batch or timestamp != crc:
+                    return
+
+                yield from batch
+                batch = []
+                crc = 0
+                continue
+
+            if position + length > size:
+                return
+
+            crc = crc32(self.view[position:position + length], crc32(header, crc))
+            batch.append((position, length, timestamp))
+            position += length
+
+    @property
+    def format(self) -> str:
+        """ MSGPACK or COLUMNAR """
+        if self._format is None:
+            self._format = self.COLUMNAR if self.index and self._is_block(*self.index[0]) else self.MSGPACK
+
+        return self._format
+
+    def _is_block(self, offset: int, length: int, timestamp: int) -> bool:
+        """ check if the record is a consistent columnar block """
+        data = self.view[offset:offset + length]
+        try:
+            timestamps, _, end = read_block(timestamp, data)
+        except (IndexError, UnicodeError):
+            return False
+
+        return end == length and len(timestamps) > 0 and max(timestamps) == int.from_bytes(data[0:4], 'big')
+
+    @property
+    def first_rows(self) -> list[int]:
+        if self._first_rows is None:
+            self._first_rows = []
+            rows = 0
+            for offset, _, _ in self.index:
+                self._first_rows.append(rows)
+                rows += int.from_bytes(self.view[offset + 4:offset + 6], 'big')
+
+        return self._first_rows
+
+    def __len__(self):
+        """ the amount of rows """
+        if self.format == self.MSGPACK or not self.index:
+            return len(self.index)
+
+        offset = self.index[-1][0]
+        return self.first_rows[-1] + int.from_bytes(self.view[offset + 4:offset + 6], 'big')
+
+    def timestamps(self) -> list[int]:
+        """ the timestamps of all rows, without decoding the data """
+        if self.format == self.MSGPACK:
+            return [timestamp for _, _, timestamp in self.index]
+
+        timestamps = []
+        for offset, length, timestamp in self.index:
+            timestamps.extend(read_block(timestamp, self.view[offset:offset + length])[0])
+
+        return timestamps
+
+    def data(self, i: int) -> memoryview:
+        """ the encoded data of the i-th record, a view on the file """
+        offset, length, _ = self.index[i]
+        return self.view[offset:offset + length]
+
+    def record(self, i: int) -> list:
+        """ decode the i-th row as [timestamp, data] """
+        if self.format == self.MSGPACK:
+            return list(self._loads(self.data(i)))
+
+        # the last block that starts at or before the row
+        low, high = 0, len(self.index) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.first_rows[middle] <= i:
+                low = middle
+            else:
+                high = middle - 1
+
+        return list(self._block_rows(low))[i - self.first_rows[low]]
+
+    def _block_rows(self, i: int, start=None, end=None, fields=None):
+        """ decode the rows of the i-th block with a timestamp in [start, end] """
+        offset, length, timestamp = self.index[i]
+        block = self.view[offset:offset + length]
+
+        high = int.from_bytes(block[0:4], 'big')
+        if (start is not None and high < start) or (end is not None and timestamp > end):
+            return
+
+        timestamps, schema, _ = read_block(timestamp, block)
+        selected = [i for i, ts in enumerate(timestamps)
+                    if (start is None or ts >= start) and (end is None or ts <= end)]
+        if not selected:
+            return
+
+        data = [{} for _ in selected]
+        for key, column_type, position, size in schema:
+            if fields is None or key in fields:
+                values = decode_column(column_type, block[position:position + size], len(timestamps))
+                for row, i in zip(data, selected):
+                    row[key] = values[i]
+
+        for row, i in zip(data, selected):
+            yield [timestamps[i], row]
+
+    def __iter__(self):
+        return self.iter_range()
+
+    def iter_range(self, start=None, end=None, fields=None):
+        """ iterate over the rows with a timestamp in [start, end], only the
+            records in the range are decoded
+        """
+        if self.format == self.COLUMNAR:
+            for i in range(len(self.index)):
+                yield from self._block_rows(i, start, end, fields)
+            return
+
+        for offset, length, timestamp in self.index:
+            if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+
+            record = list(self._loads(self.view[offset:offset + length]))
+            if fields is not None:
+                record[1] = {key: value for key, value in record[1].items() if key in fields}
+
+            yield record
+
+    def to_numpy(self, fields=None):
+        """ export all rows to a numpy structured array with a `timestamp`
+            column and a float column for every field. a field that is missing
+            in a row is NaN. without fields every numeric field is used.
+
+            the columns of a columnar file are decoded per block straight into
+            arrays, the integers, decimals and timestamps without a loop per row.
+        """
+        import numpy
+
+        if self.format == self.COLUMNAR:
+            timestamps, columns = self._columnar_arrays(numpy, fields)
+        else:
+            timestamps, columns = self._msgpack_arrays(numpy, fields)
+
+        dtype = [('timestamp', '<u4')] + [(key, '<f8') for key in columns]
+        array = numpy.empty(len(timestamps), dtype=dtype)
+        array['timestamp'] = timestamps
+        for key, column in columns.items():
+            array[key] = column
+
+        return array
+
+    def _columnar_arrays(self, numpy, fields):
+        blocks = []
+        keys = [] if fields is None else list(fields)
+
+        for offset, length, timestamp in self.index:
+            block = self.view[offset:offset + length]
+            rows, schema, position = read_schema(block)
+
+            # the timestamps are the delta-of-delta to the lowest timestamp
+            dods, position = self._varints(numpy, block, position, rows)
+            timestamps = timestamp + numpy.cumsum(numpy.cumsum(dods))
+
+            blocks.append((block, rows, timestamps, schema, position))
+            if fields is None:
+                for key, column_type, _, _ in schema:
+                    if key not in keys and column_type in (COLUMN_INT, COLUMN_DECIMAL, COLUMN_FLOAT):
+                        keys.append(key)
+
+        columns = {key: [] for key in keys}
+        for block, rows, _, schema, position in blocks:
+            found = set()
+            for key, column_type, _, size in schema:
+                if key in columns:
+                    columns[key].append(self._column(numpy, column_type, block[position:position + size], rows))
+                    found.add(key)
+                position += size
+
+            for key in keys:
+                if key not in found:
+                    columns[key].append(numpy.full(rows, numpy.nan))
+
+        timestamps = numpy.concatenate([b[2] for b in blocks]) if blocks else numpy.zeros(0, numpy.int64)
+        return timestamps, {key: numpy.concatenate(parts) if parts else numpy.zeros(0) for key, parts in columns.items()}
+
+    @staticmethod
+    def _varints(numpy, data, position: int, rows: int):
+        """ decode rows zigzag varints from position, returns them and the position after them """
+        if rows == 0:
+            return numpy.zeros(0, numpy.int64), position
+
+        raw = numpy.frombuffer(data, dtype=numpy.uint8, offset=position)
+        ends = numpy.flatnonzero(raw < 0x80)[:rows]
+        used = raw[:ends[-1] + 1].astype(numpy.uint64)
+
+        # the byte number within its varint
+        starts = numpy.concatenate(([0], ends[:-1] + 1))
+        group = numpy.zeros(len(used), numpy.int64)
+        group[starts[1:]] = 1
+        shift = numpy.arange(len(used)) - starts[numpy.cumsum(group)]
+
+        values = numpy.add.reduceat((used & 0x7f) << (7 * shift).astype(numpy.uint64), starts)
+        values = (values >> numpy.uint64(1)).astype(numpy.int64) ^ -(values & numpy.uint64(1)).astype(numpy.int64)
+
+        return values, position + int(ends[-1]) + 1
+
+    def _column(self, numpy, column_type: int, data, rows: int):
+        if column_type == COLUMN_INT:
+            return numpy.cumsum(self._varints(numpy, data, 0, rows)[0]).astype(numpy.float64)
+
+        if column_type == COLUMN_DECIMAL:
+            # the same division as decode_column, the scaled values are exact in a double
+            return numpy.cumsum(self._varints(numpy, data, 1, rows)[0]).astype(numpy.float64) / 10 ** data[0]
+
+        if column_type == COLUMN_FLOAT:
+            return numpy.fromiter(decode_column(column_type, data, rows), numpy.float64, rows)
+
+        return numpy.fromiter((self._number(value) for value in decode_column(column_type, data, rows)),
+                              numpy.float64, rows)
+
+    def _msgpack_arrays(self, numpy, fields):
+        rows = [data for _, data in self]
+        if fields is None:
+            fields = []
+            for data in rows:
+                for key, value in data.items():
+                    if key not in fields and type(value) in (int, float):
+                        fields.append(key)
+
+        columns = {key: numpy.fromiter((self._number(data.get(key)) for data in rows), numpy.float64, len(rows))
+                   for key in fields}
+        return numpy.fromiter((timestamp for _, _, timestamp in self.index), numpy.int64, len(rows)), columns
+
+    @staticmethod
+    def _number(value) -> float:
+        return value if type(value) in (int, float) else float('nan')
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
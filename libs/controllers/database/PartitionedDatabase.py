@@ -0,0 +1,212 @@
+from libs.controllers.database.SegmentDatabase import SegmentDatabase
+from libs.controllers.database.Aggregate import AggregateIndex
+from libs.controllers.database import IDatabaseController
+from libs.controllers.storage import IStorageController
+
+import os
+
+
+def _next(iterator):
+    """ the next item of the iterator or None, next() with a default is not available on every port """
+    try:
+        return next(iterator)
+    except StopIteration:
+        return None
+
+
+class PartitionedDatabase(IDatabaseController):
+    """
+        store the data of every node in its own segment chain.
+
+        the records are partitioned on the `address` field of the data. every
+        address gets a SegmentDatabase with `<filename>.<address in hex>` as
+        filename, for example `/sd/data.db.00a2.0` and `/sd/data.db.00a2.idx`.
+
+        a query for a single node only reads the files of that node and when we
+        stop replicating a node its data can be removed by deleting its files.
+        the partitions are opened when they are first used. `database` is the
+        SegmentDatabase (sub)class used for the partitions.
+
+        the rollups of a node made by the CompactionController are stored next
+        to its partition, with the resolution in seconds in the filename, for
+        example `/sd/data.db.00a2.r60.0`.
+
+        for every resolution in `aggregate_resolutions` the rollups are
+        maintained on insert by an AggregateIndex, `aggregate` and
+        `iter_buckets` answer questions like the hourly mean temperature of a
+        node from those rollups.
+    """
+
+    def __init__(self, filename: str, storage_controller: IStorageController,
+                 database=SegmentDatabase, aggregate_resolutions=(), **segment_options):
+        self.storage_controller = storage_controller
+        self.filename = filename
+        self.database = database
+        self.segment_options = segment_options
+
+        self.index = AggregateIndex(self, aggregate_resolutions)
+
+        self.partitions: dict[int, SegmentDatabase] = {}
+        self.rollups: dict[tuple[int, int], SegmentDatabase] = {}
+
+    def _partition_name(self, address: int) -> str:
+        return f'{self.filename}.{address:04x}'
+
+    def partition(self, address: int) -> SegmentDatabase:
+        """ get the partition of the address, it is created if it does not exist """
+        if address not in self.partitions:
+            self.partitions[address] = self.database(
+                self._partition_name(address), self.storage_controller, **self.segment_options)
+
+        return self.partitions[address]
+
+    def rollup(self, address: int, resolution: int) -> SegmentDatabase:
+        """ get the rollups of the address with a resolution in seconds, it is created if it does not exist """
+        if (address, resolution) not in self.rollups:
+            self.rollups[(address, resolution)] = self.database(
+                f'{self._partition_name(address)}.r{resolution}', self.storage_controller, **self.segment_options)
+
+        return self.rollups[(address, resolution)]
+
+    def resolutions(self, address: int) -> list[int]:
+        """ get the resolutions of the rollups of the address """
+        resolutions = set(r for a, r in self.rollups.keys() if a == address)
+
+        directory, _, name = self._partition_name(address).rpartition('/')
+        for f in os.listdir(directory or '.'):
+            if not f.startswith(name + '.r') or not f.endswith('.idx'):
+                continue
+
+            try:
+                resolutions.add(int(f[len(name) + 2:-4]))
+            except ValueError:
+                pass
+
+        return sorted(resolutions)
+
+    def addresses(self) -> list[int]:
+        """ get the addresses of all the partitions, including the ones on disk that are not opened yet """
+        addresses = set(self.partitions.keys())
+
+        directory, _, name = self.filename.rpartition('/')
+        for f in os.listdir(directory or '.'):
+            # only the index file is unique for every partition
+            if not f.startswith(name + '.') or not f.endswith('.idx'):
+                continue
+
+            try:
+                addresses.add(int(f[len(name) + 1:-4], 16))
+            except ValueError:
+                pass
+
+        return sorted(addresses)
+
+    def _has(self, address: int) -> bool:
+        return address in self.partitions or address in self.addresses()
+
+    def drop(self, address: int):
+        """ remove all data stored for the address """
+        self.index.drop(address)
+        for resolution in self.resolutions(address):
+            self.rollup(address, resolution).destroy()
+            del self.rollups[(address, resolution)]
+
+        if self._has(address):
+            self.partition(address).destroy()
+            del self.partitions[address]
+
+    def store(self, timestamp, data):
+        self.index.add(data['address'], timestamp, data)
+        self.partition(data['address']).store(timestamp, data)
+
+    def iter_buckets(self, address: int, start: int, end: int, resolution: int):
+        """ iterate over the aggregates of the buckets of the node that overlap with [start, end] """
+        return self.index.iter_buckets(address, start, end, resolution)
+
+    def aggregate(self, address: int, start: int, end: int, resolution: int) -> dict:
+        """ the count, mean, min and max of the fields of the node in [start, end],
+            using the buckets of the resolution
+        """
+        return self.index.aggregate(address, start, end, resolution)
+
+    def sync(self):
+        for partition in self.partitions.values():
+            partition.sync()
+
+        for rollup in self.rollups.values():
+            rollup.sync()
+
+    def get_range(self, address: int, start, end, fields=None) -> list:
+        """ get all the records of the node with a timestamp in [start, end] """
+        return list(self.iter_range(start, end, fields, address))
+
+    def iter_range(self, start=None, end=None, fields=None, address=None):
+        """ iterate over the records with a timestamp in [start, end]. when the
+            address is given only the partition of that node is read, otherwise
+            the partitions are merged in time order.
+        """
+        if address is not None:
+            if self._has(address):
+                yield from self.partition(address).iter_range(start, end, fields)
+            return
+
+        # merge the partitions, keep the next record of every partition
+        iterators = [self.partition(a).iter_range(start, end, fields) for a in self.addresses()]
+        heads = [_next(iterator) for iterator in iterators]
+
+        while True:
+            current = None
+            for i, head in enumerate(heads):
+                if head is not None and (current is None or head[0] < heads[current][0]):
+                    current = i
+
+            if current is None:
+                return
+
+            yield heads[current]
+            heads[current] = _next(iterators[current])
+
+    def get(self, timestamp):
+        for address in self.addresses():
+            record = self.partition(address).get(timestamp)
+            if record is not None:
+                return record
+
+        return None
+
+    def get_all(self):
+        return list(self.iter_range())
+
+    def get_all_between(self, start, end, inclusive=False):
+        if not inclusive:
+            start, end = start + 1, end - 1
+
+        return list(self.iter_range(start, end))
+
+    def get_all_after(self, timestamp, inclusive=False):
+        if not inclusive:
+            timestamp += 1
+
+        return list(self.iter_range(start=timestamp))
+
+    def get_all_before(self, timestamp, inclusive=False):
+        if not inclusive:
+            timestamp -= 1
+
+        return list(self.iter_range(end=timestamp))
+
+    def close(self):
+        """ store the open buckets of the aggregates and close all partitions and rollups """
+        self.index.close()
+
+        for partition in self.partitions.values():
+            partition.close()
+
+        for rollup in self.rollups.values():
+            rollup.close()
+
+        self.partitions = {}
+        self.rollups = {}
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,501 @@
+from libs.controllers.database.BufferedWriter import BufferedWriter, record_marker
+from libs.controllers.database import IDatabaseController
+from libs.controllers.storage import IStorageController
+from libs.external.ChannelLogger import logger
+
+import libs.external.umsgpack as umsgpack
+
+from binascii import crc32
+import os
+
+
+class SegmentDatabase(IDatabaseController):
+    """
+        store the data in append-only segments with a sparse timestamp index.
+
+        the records use the same format as the BinarKVDatabase:
+            - 4 bytes: total length of the data
+            - 4 bytes: timestamp
+            - the rest: the data in a msgpack format
+
+        the records are split over multiple segment files (`<filename>.<n>`).
+        every `block_records` records the current block is closed and an entry
+        is appended to the index file (`<filename>.idx`):
+            - 2 bytes: segment number
+            - 4 bytes: offset of the block in the segment
+            - 4 bytes: length of the block
+            - 4 bytes: lowest timestamp in the block
+            - 4 bytes: highest timestamp in the block
+
+        once a segment grows past `segment_size` bytes the next record is
+        written to a new segment, so a block never spans two segments.
+
+        the index is kept in memory. a query does a binary search over the
+        running maximum of the blocks to find the first block that can contain
+        the start of the range and only reads the blocks that overlap with the
+        requested range. when the blocks are in time order (the normal case)
+        the search also stops at the first block past the end of the range.
+
+        the last block is not in the index file until it is closed, on open it
+        is rebuilt by scanning the records after the last indexed block.
+
+        the records are written through a BufferedWriter, every committed batch
+        ends with a record with a length of 0 as marker, as does every block.
+        the index entries of closed blocks are only written after the batch
+        holding the block is committed. when the scan on open finds records after the last marker,
+        or a marker that does not match the crc32 of its batch, the last batch
+        was torn. the records before it are closed as a block and the database
+        continues in a new segment so the torn bytes are never read.
+    """
+
+    HEADER_SIZE = 8
+    INDEX_ENTRY_SIZE = 18
+
+    # amount of bytes of the data `_bounds` needs to know the timestamps of a record
+    BOUNDS_SIZE = 0
+
+    def __init__(self, filename: str, storage_controller: IStorageController,
+                 block_records: int = 32, segment_size: int = 65536,
+                 max_bytes: int = 512, max_delay: int = 60):
+        self.storage_controller = storage_controller
+        self.filename = filename
+        self.block_records = block_records
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        # the closed blocks. (segment, offset, length, min, max)
+        self.blocks: list[tuple[int, int, int, int, int]] = []
+        # running maximum of the block maxima, this is sorted and used to bisect
+        self.highs: list[int] = []
+        # true as long as every block starts after the end of the previous one
+        self.ordered = True
+
+        # the block that is currently being written
+        self.segment = 0
+        self.tail_offset = 0
+        self.tail_count = 0
+        self.tail_min = None
+        self.tail_max = None
+
+        # the index entries of blocks that are not committed yet
+        self.pending_blocks: list[bytes] = []
+
+        # load the index and open the segment we are appending to
+        self.storage_controller.ensure_exists(self._index_path())
+        self._load_index()
+
+        self.index_handle = open(self._index_path(), 'ab')
+        self._open_segment()
+        self._scan_tail()
+
+    def _segment_path(self, segment: int) -> str:
+        return f'{self.filename}.{segment}'
+
+    def _index_path(self) -> str:
+        return f'{self.filename}.idx'
+
+    def _load_index(self):
+        """ read the index file and find the segment and offset of the tail block """
+        with open(self._index_path(), 'rb') as f:
+            while True:
+                entry = f.read(self.INDEX_ENTRY_SIZE)
+                if len(entry) < self.INDEX_ENTRY_SIZE:
+                    break
+
+                self._add_block(
+                    int.from_bytes(entry[0:2], 'big'),
+                    int.from_bytes(entry[2:6], 'big'),
+                    int.from_bytes(entry[6:10], 'big'),
+                    int.from_bytes(entry[10:14], 'big'),
+                    int.from_bytes(entry[14:18], 'big'),
+                )
+
+        # the tail is in the last segment, right after the last indexed block
+        # or at the start when the segment was rolled over after that block
+        self.segment = self._last_segment()
+
+        if self.blocks and self.blocks[-1][0] == self.segment:
+            _, offset, length, _, _ = self.blocks[-1]
+            self.tail_offset = offset + length
+
+    def _last_segment(self) -> int:
+        """ the highest segment number on disk, segments before it can be dropped """
+        directory, _, name = self.filename.rpartition('/')
+        last = self.blocks[-1][0] if self.blocks else 0
+
+        for f in os.listdir(directory or '.'):
+            if not f.startswith(name + '.'):
+                continue
+
+            try:
+                last = max(last, int(f[len(name) + 1:]))
+            except ValueError:
+                pass
+
+        return last
+
+    def _open_segment(self):
+        """ open the current segment for appending """
+        self.storage_controller.ensure_exists(self._segment_path(self.segment))
+        self.handle = open(self._segment_path(self.segment), 'a+b')
+
+        self.handle.seek(0, 2)
+        self.writer = BufferedWriter(self.handle, self.handle.tell(), self.max_bytes,
+                                     self.max_delay, record_marker)
+
+    def _scan_tail(self):
+        """ rebuild the state of the block that was not closed yet and detect a torn batch """
+        # the bounds and checksum of the records after the last marker
+        batch = []
+        crc = 0
+        good = self.tail_offset
+
+        self.handle.seek(self.tail_offset)
+        while True:
+            header = self.handle.read(self.HEADER_SIZE)
+            if len(header) < self.HEADER_SIZE:
+                break
+
+            length = int.from_bytes(header[0:4], 'big')
+            timestamp = int.from_bytes(header[4:8], 'big')
+
+            # a marker, all records before it are committed. a marker without
+            # records is never written, it is space the file system allocated
+            # but never wrote
+            if length == 0:
+                if not batch or timestamp != crc:
+                    break
+
+                for bounds in batch:
+                    self._track(*bounds)
+                batch = []
+                crc = 0
+                good = self.handle.tell()
+                continue
+
+            data = self.handle.read(length)
+            if len(data) < length:
+                break
+
+            crc = crc32(data, crc32(header, crc))
+            batch.append(self._bounds(timestamp, data[:self.BOUNDS_SIZE]))
+
+        if good == self.writer.position:
+            return
+
+        # the last batch is torn. keep what was committed and continue in a new segment
+        logger(f'{self._segment_path(self.segment)} has a torn batch after {good}, continuing in a new segment',
+               channel='warning')
+        self.writer.position = good
+        self._close_block()
+        self._roll()
+
+    @staticmethod
+    def _exists(path: str) -> bool:
+        try:
+            os.stat(path)
+            return True
+        except OSError:
+            return False
+
+    def _add_block(self, segment, offset, length, low, high):
+        """ add a closed block to the in memory index """
+        if self.highs:
+            if low < self.highs[-1]:
+                self.ordered = False
+            high_water = max(high, self.highs[-1])
+        else:
+            high_water = high
+
+        self.blocks.append((segment, offset, length, low, high))
+        self.highs.append(high_water)
+
+    @staticmethod
+    def _index_entry(block) -> bytes:
+        return b''.join([
+            block[0].to_bytes(2, 'big'),
+            block[1].to_bytes(4, 'big'),
+            block[2].to_bytes(4, 'big'),
+            block[3].to_bytes(4, 'big'),
+            block[4].to_bytes(4, 'big'),
+        ])
+
+    def _track(self, low: int, high: int):
+        """ account a record in the tail block """
+        self.tail_count += 1
+        if self.tail_min is None or low < self.tail_min:
+            self.tail_min = low
+        if self.tail_max is None or high > self.tail_max:
+            self.tail_max = high
+
+    def _close_block(self):
+        """ write the tail block to the index and start a new block """
+        if self.tail_count == 0:
+            return
+
+        # a batch never spans two blocks, the scan on open can check every batch after the last block
+        self.writer.mark()
+
+        entry = (self.segment, self.tail_offset, self.writer.size - self.tail_offset,
+                 self.tail_min, self.tail_max)
+        self.pending_blocks.append(self._index_entry(entry))
+        self._add_block(*entry)
+
+        self.tail_offset = self.writer.size
+        self.tail_count = 0
+        self.tail_min = None
+        self.tail_max = None
+
+        # roll over to a new segment once this one is full
+        if self.writer.size >= self.segment_size:
+            self._roll()
+
+    def _roll(self):
+        """ continue in a new segment """
+        self.sync()
+        self.handle.close()
+
+        self.segment += 1
+        self.tail_offset = 0
+        self._open_segment()
+
+    def _append(self, timestamp: int, binary: bytes, high=None):
+        """ append a record to the current segment and close the block when it is full.
+            a record can hold data up to `high`, by default it only holds `timestamp`
+        """
+        # encoded "total length of the data" + "timestamp" + "data"
+        self.writer.write(len(binary).to_bytes(4, 'big') + timestamp.to_bytes(4, 'big') + binary)
+        self._track(timestamp, timestamp if high is None else high)
+
+        if self.tail_count >= self.block_records:
+            self._close_block()
+
+        if self.writer.due():
+            self.sync()
+
+    def sync(self):
+        """ commit the buffered records, followed by the index entries of the closed blocks """
+        self.writer.commit()
+
+        if self.pending_blocks:
+            self.index_handle.write(b''.join(self.pending_blocks))
+            self.index_handle.flush()
+            self.pending_blocks = []
+
+    def store(self, timestamp, data):
+        self._append(timestamp, umsgpack.dumps((timestamp, data)))
+
+    def _bounds(self, timestamp: int, prefix: bytes) -> tuple[int, int]:
+        """ the lowest and highest timestamp in a record, prefix holds the first
+            `BOUNDS_SIZE` bytes of the data
+        """
+        return timestamp, timestamp
+
+    def _rows(self, timestamp: int, binary: bytes, start, end, fields):
+        """ decode the rows in a record with a timestamp in [start, end] """
+        if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+            return
+
+        row = umsgpack.loads(bytes(binary))
+        if fields is not None:
+            row[1] = {key: value for key, value in row[1].items() if key in fields}
+
+        yield row
+
+    def _first_block(self, timestamp) -> int:
+        """ binary search for the first block that can hold a record at or after timestamp """
+        low, high = 0, len(self.highs)
+        while low < high:
+            middle = (low + high) // 2
+            if self.highs[middle] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def _records(self, block, start, end, fields):
+        """ decode the rows of all records in the block with a timestamp in [start, end] """
+        position = 0
+        while position + self.HEADER_SIZE <= len(block):
+            length = int.from_bytes(block[position:position + 4], 'big')
+            ts = int.from_bytes(block[position + 4:position + 8], 'big')
+            position += self.HEADER_SIZE
+
+            # skip the commit markers
+            if length == 0:
+                continue
+
+            yield from self._rows(ts, block[position:position + length], start, end, fields)
+
+            position += length
+
+    def _candidates(self, start, end):
+        """ the closed blocks that can hold records with a timestamp in [start, end] """
+        # the index is replaced when a segment is dropped, keep using this one
+        blocks = self.blocks
+
+        first = 0 if start is None else self._first_block(start)
+        for i in range(first, len(blocks)):
+            segment, offset, length, low, high = blocks[i]
+
+            # all the remaining blocks start after the range
+            if end is not None and low > end:
+                if self.ordered:
+                    break
+                continue
+
+            if start is not None and high < start:
+                continue
+
+            yield blocks[i]
+
+    def _iter_blocks(self, blocks, start, end, fields):
+        """ read the blocks one at a time into a buffer that is reused for all
+            blocks and iterate over their records
+        """
+        buffer = bytearray(0)
+        handle = None
+        handle_segment = None
+
+        try:
+            for segment, offset, length, _, _ in blocks:
+                if length > len(buffer):
+                    buffer = bytearray(length)
+                view = memoryview(buffer)[:length]
+
+                if segment == self.segment:
+                    self.writer.readinto(offset, view)
+                else:
+                    # keep the segment open, the next block is likely in the same segment
+                    if handle_segment != segment:
+                        if handle is not None:
+                            handle.close()
+                        handle = open(self._segment_path(segment), 'rb')
+                        handle_segment = segment
+
+                    handle.seek(offset)
+                    handle.readinto(view)
+
+                yield from self._records(view, start, end, fields)
+        finally:
+            if handle is not None:
+                handle.close()
+
+    def iter_range(self, start=None, end=None, fields=None):
+        """ iterate over all records with a timestamp in [start, end]. None means unbounded.
+            when fields is set only those keys of the data are returned.
+
+            the blocks are read one at a time, so only a single block is in
+            memory at once.
+        """
+        yield from self._iter_blocks(self._candidates(start, end), start, end, fields)
+
+        # the tail block is not in the index
+        if self.tail_count > 0 \
+                and (end is None or self.tail_min <= end) \
+                and (start is None or self.tail_max >= start):
+            tail = (self.segment, self.tail_offset, self.writer.size - self.tail_offset, None, None)
+            yield from self._iter_blocks((tail,), start, end, fields)
+
+    def last_timestamp(self) -> int | None:
+        """ the highest timestamp in the database, None when it is empty """
+        last = self.highs[-1] if self.highs else None
+        if self.tail_count > 0 and (last is None or self.tail_max > last):
+            last = self.tail_max
+
+        return last
+
+    def closed_segments(self) -> list[tuple[int, int, int]]:
+        """ the segment, lowest and highest timestamp of the segments that are not written to anymore """
+        segments = {}
+        for segment, _, _, low, high in self.blocks:
+            if segment == self.segment:
+                continue
+
+            if segment in segments:
+                low = min(low, segments[segment][0])
+                high = max(high, segments[segment][1])
+            segments[segment] = (low, high)
+
+        return [(segment, low, high) for segment, (low, high) in sorted(segments.items())]
+
+    def iter_segment(self, segment: int):
+        """ iterate over all records in a closed segment """
+        blocks = [block for block in self.blocks if block[0] == segment]
+        yield from self._iter_blocks(blocks, None, None, None)
+
+    def drop_segment(self, segment: int):
+        """ delete a closed segment and remove its blocks from the index """
+        if segment == self.segment:
+            raise ValueError('the current segment can not be dropped')
+
+        self.sync()
+
+        blocks = [block for block in self.blocks if block[0] != segment]
+        self.blocks = []
+        self.highs = []
+        self.ordered = True
+        for block in blocks:
+            self._add_block(*block)
+
+        # rewrite the index without the segment and replace the old one
+        self.index_handle.close()
+        with open(self._index_path() + '.tmp', 'wb') as f:
+            for block in self.blocks:
+                f.write(self._index_entry(block))
+        os.rename(self._index_path() + '.tmp', self._index_path())
+        self.index_handle = open(self._index_path(), 'ab')
+
+        if self._exists(self._segment_path(segment)):
+            os.remove(self._segment_path(segment))
+
+    def get_range(self, start=None, end=None, fields=None) -> list:
+        """ get all records with a timestamp in [start, end], optionally only with the keys in fields """
+        return list(self.iter_range(start, end, fields))
+
+    def get(self, timestamp):
+        for record in self.iter_range(timestamp, timestamp):
+            return record
+
+        return None
+
+    def get_all(self):
+        return list(self.iter_range())
+
+    def get_all_between(self, start, end, inclusive=False):
+        if not inclusive:
+            start, end = start + 1, end - 1
+
+        return list(self.iter_range(start, end))
+
+    def get_all_after(self, timestamp, inclusive=False):
+        if not inclusive:
+            timestamp += 1
+
+        return list(self.iter_range(start=timestamp))
+
+    def get_all_before(self, timestamp, inclusive=False):
+        if not inclusive:
+            timestamp -= 1
+
+        return list(self.iter_range(end=timestamp))
+
+    def close(self):
+        self.sync()
+        self.handle.close()
+        self.index_handle.close()
+
+    def destroy(self):
+        """ close the database and delete all its segments and the index """
+        self.close()
+
+        for segment in range(self.segment + 1):
+            if self._exists(self._segment_path(segment)):
+                os.remove(self._segment_path(segment))
+
+        os.remove(self._index_path())
+
+    def __del__(self):
+        self.close()
@@ -1,8 +1,15 @@
+import asyncio
+
+
 class IDatabaseController:
 
     def store(self, timestamp, data):
         raise NotImplementedError()
 
+    def sync(self):
+        """ write all buffered records to the storage """
+        raise NotImplementedError()
+
     def get(self, timestamp):
         raise NotImplementedError()
 
@@ -17,3 +24,22 @@ class IDatabaseController:
 
     def get_all_before(self, timestamp):
         raise NotImplementedError()
+
+    def iter_range(self, start=None, end=None, fields=None):
+        """ iterate over the records with a timestamp in [start, end], None means
+            unbounded. the records are read one at a time instead of as a list.
+        """
+        raise NotImplementedError()
+
+    def start(self, period: int = 60):
+        """ sync the database every `period` seconds, this is the durability window of buffered records """
+        loop = asyncio.get_event_loop()
+        self.task = loop.create_task(self._start(period))
+
+    def stop(self):
+        self.task.cancel()
+
+    async def _start(self, period: int = 60):
+        while True:
+            await asyncio.sleep(period)
+            self.sync()
@@ -0,0 +1,81 @@
+import asyncio
+
+
+class MeasurementBatcher:
+    """
+        pack multiple encoded measurements into a single frame.
+
+        every measurement frame costs a frame header, the crc and the reed
+        solomon bytes on top of the airtime to get the channel. the batcher
+        collects our own measurements and sends them with `send` as one batch
+        once the next one does not fit in `max_size` bytes or every
+        `max_delay` seconds.
+
+        the measurements are broadcasted and broadcasts are not forwarded, so
+        every measurement in a batch was made by the source of the frame.
+        a batch is a list of entries:
+            - 1 byte: length of the measurement
+            - the encoded measurement
+    """
+
+    ENTRY_HEADER_SIZE = 1
+
+    def __init__(self, send, max_size: int = 190, max_delay: int = 30):
+        self.send = send
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self.entries: list[bytes] = []
+        self.size = 0
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.task = loop.create_task(self._start())
+
+    def stop(self):
+        self.task.cancel()
+        self.flush()
+
+    async def _start(self):
+        while True:
+            await asyncio.sleep(self.max_delay)
+            self.flush()
+
+    def add(self, measurement: bytes):
+        """ add an encoded measurement to the batch """
+        entry = b''.join([
+            len(measurement).to_bytes(1, 'big'),
+            measurement,
+        ])
+
+        if self.size + len(entry) > self.max_size:
+            self.flush()
+
+        self.entries.append(entry)
+        self.size += len(entry)
+
+    def flush(self):
+        """ send the measurements in the batch, even when it is not full """
+        if not self.entries:
+            return
+
+        batch = b''.join(self.entries)
+        self.entries = []
+        self.size = 0
+
+        self.send(batch)
+
+    @staticmethod
+    def unpack(batch: bytes) -> list[bytes]:
+        """ the encoded measurement of every entry in a batch """
+        entries = []
+
+        position = 0
+        while position + MeasurementBatcher.ENTRY_HEADER_SIZE <= len(batch):
+            length = batch[position]
+            position += MeasurementBatcher.ENTRY_HEADER_SIZE
+
+            entries.append(batch[position:position + length])
+            position += length
+
+        return entries
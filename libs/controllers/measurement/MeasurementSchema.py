@@ -0,0 +1,91 @@
+from libs.controllers.measurement.Measurement import Measurement
+
+from binascii import crc32
+
+
+class MeasurementSchema:
+    """
+        the fields a node measures, used to send measurements without the keys.
+
+        a node announces its schema in its config. after that a measurement is
+        encoded as:
+            - 1 byte: COMPACT, a byte msgpack never uses so both formats can be told apart
+            - 1 byte: the id of the schema
+            - 4 bytes: timestamp
+            - 4 bytes for every field: the value times the scale of the field as a signed integer
+
+        the id is a checksum of the fields, a receiver with an old schema of the
+        node sees that the id does not match instead of decoding garbage.
+        integers get a scale of 1, floats are kept with `FLOAT_SCALE`.
+    """
+
+    COMPACT = 0xc1
+    FLOAT_SCALE = 100
+
+    def __init__(self, fields: list[tuple[str, int]]):
+        self.fields = fields
+        self.id = crc32(','.join([f'{name}:{scale}' for name, scale in fields]).encode()) & 0xff
+
+    @staticmethod
+    def from_measurement(measurement: Measurement):
+        """ make a schema for the fields of a measurement, None when a value is not a number """
+        fields = []
+        for key, value in measurement.data.items():
+            if type(value) is int:
+                fields.append((key, 1))
+            elif type(value) is float:
+                fields.append((key, MeasurementSchema.FLOAT_SCALE))
+            else:
+                return None
+
+        return MeasurementSchema(fields)
+
+    def serialize(self) -> list:
+        """ the schema as it is stored in the config """
+        return [[name, scale] for name, scale in self.fields]
+
+    @staticmethod
+    def deserialize(fields: list):
+        return MeasurementSchema([(name, scale) for name, scale in fields])
+
+    def encode(self, measurement: Measurement) -> bytes | None:
+        """ encode the measurement, None when it does not fit the schema """
+        if len(measurement.data) != len(self.fields):
+            return None
+
+        values = []
+        for name, scale in self.fields:
+            value = measurement.data.get(name)
+            if type(value) not in (int, float):
+                return None
+
+            scaled = round(value * scale)
+            if not -0x80000000 <= scaled <= 0x7fffffff:
+                return None
+
+            # two's complement, not every port supports signed to_bytes
+            values.append((scaled & 0xffffffff).to_bytes(4, 'big'))
+
+        return b''.join([
+            bytes([self.COMPACT, self.id]),
+            measurement.timestamp.to_bytes(4, 'big'),
+        ] + values)
+
+    def decode(self, bits: bytes) -> Measurement | None:
+        """ decode a compact measurement, None when it was encoded with another schema """
+        if bits[1] != self.id or len(bits) != 6 + 4 * len(self.fields):
+            return None
+
+        data = {}
+        for i, (name, scale) in enumerate(self.fields):
+            value = int.from_bytes(bits[6 + 4 * i:10 + 4 * i], 'big')
+            if value & 0x80000000:
+                value -= 0x100000000
+
+            data[name] = value if scale == 1 else value / scale
+
+        return Measurement(int.from_bytes(bits[2:6], 'big'), **data)
+
+    @staticmethod
+    def is_compact(bits: bytes) -> bool:
+        return len(bits) > 0 and bits[0] == MeasurementSchema.COMPACT
@@ -22,6 +22,24 @@ class NeighboursController():
         self.max_timeout = max_timeout
         self.heartbeat = heartbeat
 
+        # called with the address of a neighbour that is gone
+        self.eviction_callbacks: list = []
+
+    def register_eviction_callback(self, callback):
+        """ register a callback for when a neighbour leaves or times out """
+        self.eviction_callbacks.append(callback)
+
+    def evict(self, address: int):
+        """ forget a neighbour """
+        self.connections.pop(address, None)
+        self.last_update.pop(address, None)
+
+        for callback in self.eviction_callbacks:
+            try:
+                callback(address)
+            except Exception as e:
+                logger(f'error in eviction callback for {address}: {e}', channel='error')
+
     def broadcast_join(self):
         """
         Broadcasts a message with its config for when the node starts up.
@@ -43,10 +61,9 @@ class NeighboursController():
     async def nodes_alive_loop(self):
         while True:
             await asyncio.sleep(self.max_timeout)
-            for node in self.connections:
-                if node not in self.last_update or self.last_update[node] + self.max_timeout > time():
-                    self.last_update.pop(node)
-                    self.connections.pop(node)
+            for node in [node for node in self.connections
+                         if node not in self.last_update or self.last_update[node] + self.max_timeout < time()]:
+                self.evict(node)
 
     def handle_join(self, frame: Frame):
         """
@@ -78,21 +95,25 @@ class NeighboursController():
             return
 
         id = int.from_bytes(frame.data, 'big')
-        self.connections.pop(id)
-        self.last_update.pop(id)
+        self.evict(id)
         logger("Node leaving network created, current table: ", self.connections, channel='routing')
 
     def handle_alive(self, frame: Frame):
         """
-        Handles a node being alive, updates the config.
+        Handles a node being alive, updates the config. Only a frame the node
+        send us itself (hops 0) shows that it is a neighbour and alive, a
+        forwarded frame only updates the config in the ledger.
         """
-        self.last_update[frame.source_address] = time()
+        neighbour = frame.hops == 0
+        if neighbour:
+            self.last_update[frame.source_address] = time()
 
         if frame.type != Frame.FRAME_TYPES['node_alive']:
             return
 
         node = NodeConfigData.deserialize(frame.data)
-        self.connections[frame.source_address] = node
+        if neighbour:
+            self.connections[frame.source_address] = node
         self.config_controller.ledger[frame.source_address] = node
 
         logger("A node has send a heartbeat, current table: ", self.connections, channel='routing')
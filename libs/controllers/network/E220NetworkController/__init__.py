@@ -1,9 +1,10 @@
 from libs.controllers.network.E220NetworkController.E220 import E220, MODE_CONFIG, MODE_NORMAL
 from libs.controllers.network.routing import RoutingController
+from libs.controllers.network.stream import PacketStream
+from libs.controllers.network.error.LinkQuality import LinkQuality
 from libs.controllers.network import Frame, INetworkController
 from libs.external.ChannelLogger import logger
 
-import asyncio
 import config as cfg
 
 
@@ -15,6 +16,7 @@ class E220NetworkController(INetworkController):
         super().__init__()
 
         self.e220 = e220
+        self.links = LinkQuality()
 
         self.e220.set_mode(MODE_CONFIG)
         self.e220.get_settings()
@@ -35,15 +37,15 @@ class E220NetworkController(INetworkController):
         self.e220.set_mode(MODE_NORMAL)
 
     async def _start(self):
-        # start separate thread
+        # the e220 adds the rssi byte after every packet when it is enabled
+        self.stream = PacketStream(self.e220.serial, 1 if cfg.rssi_enabled else 0)  # type: ignore
+
         while True:
-            d = self.e220.read()
-            if d:
-                self.on_message(d)
-            await asyncio.sleep(0.1)
+            self.on_message(await self.stream.read())
 
-    def _send_message(self, type: int, message: bytes, address: int):
-        frame = Frame(type, message, self.address, address)
+    def _send_message(self, frame: Frame):
+        type = frame.type
+        address = frame.destination_address
         dest = address
 
         # If the frame is a routing request, we shuold put the destionation to
@@ -54,16 +56,20 @@ class E220NetworkController(INetworkController):
         # If the request isnt a broadcast or a routing request, check what the
         # destionation should be
         elif address != 0xffff and type != Frame.FRAME_TYPES['routing_response']:
-            dest = self.routing_controller.get_route(address)
+            dest = self.routing_controller.get_route(address, forwarding=frame.source_address != self.address)
 
-        # If destination is unkown, put it back on the queue
+        # If destination is unkown, park it until the route is found
         if dest == -1:
-            self.send_message(type, message, address)
+            self.routing_controller.park(frame)
             return
 
-        logger(f'sending frame {frame.__dict__}', channel='send_message')
-        self.e220.send(dest.to_bytes(2, 'big'),
-                       self.crc.encode(frame.serialize()))
+        if logger.enabled('send_message'):
+            logger(f'sending frame {frame.__dict__}', channel='send_message')
+        # the frame is split at the size that fits the strongest encoding, the
+        # nodes forwarding the fragments can use any strength for their link
+        strength = self.links.strength(dest)
+        for packet in self._packets(frame):
+            self.e220.send(dest.to_bytes(2, 'big'), PacketStream.pack(self.crc.encode(packet, strength)))
 
     def _decode_message(self, message: bytes):
         rssi = 1
@@ -77,7 +83,22 @@ class E220NetworkController(INetworkController):
         if decode is None:
             return None
 
-        return Frame.deserialize(decode, rssi)
+        frame = Frame.deserialize(decode, rssi)
+
+        # only a frame that was not forwarded tells something about the link to its source
+        if frame.hops == 0:
+            self.links.update(frame.source_address, rssi if cfg.rssi_enabled else None, self.crc.errors)  # type: ignore
+
+        return frame
+
+    def _max_frame_size(self, strength: int) -> int:
+        """ the sub packet size minus the packet header, reed solomon and crc bytes """
+        return self.e220.sub_packet - PacketStream.HEADER_SIZE - self.crc.overhead(strength)
+
+    @property
+    def max_frame_size(self) -> int:
+        """ the largest frame that fits in a packet with every strength """
+        return self._max_frame_size(max(self.crc.STRENGTHS))
 
     @property
     def address(self) -> int:
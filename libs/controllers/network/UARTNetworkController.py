@@ -1,10 +1,11 @@
-from libs.controllers.network import INetworkController
+from libs.controllers.network import Frame, INetworkController
+from libs.controllers.network.stream import PacketStream
 from machine import UART
 
-import asyncio
-
 
 class UARTNetworkController(INetworkController):
+    # a packet holds at most 255 bytes, larger frames are fragmented
+    max_frame_size = PacketStream.MAX_SIZE
 
     def __init__(self, uart: UART):
         super().__init__()
@@ -12,10 +13,11 @@ class UARTNetworkController(INetworkController):
         self.callbacks = {}
 
     async def _start(self):
+        self.stream = PacketStream(self.uart)
+
         while True:
-            if self.uart.any():
-                self.on_message(self.uart.read())
-            await asyncio.sleep(0.1)
+            self.on_message(await self.stream.read())
 
-    def _send_message(self, type: int, message: bytes, addr):
-        self.uart.write(message)
+    def _send_message(self, frame: Frame):
+        for packet in self._packets(frame):
+            self.uart.write(PacketStream.pack(packet))
@@ -1,9 +1,24 @@
+from time import sleep, time
 import _thread
 import asyncio
-import time
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    # not on the board
+    from time import perf_counter_ns
+
+    def ticks_us():
+        return perf_counter_ns() // 1000
+
+    def ticks_diff(a, b):
+        return a - b
 
 from libs.external.ChannelLogger import logger
 from libs.controllers.network.error.CRC import CRC
+from libs.controllers.network.queue import SendQueue
+from libs.controllers.network.fragmentation import Fragmenter, Reassembler
+from libs.controllers.network.duplicates import SeenCache
 
 
 class Frame:
@@ -12,28 +27,85 @@ class Frame:
         'measurement':      0x01,
         'config':           0x02,
         'replication':      0x03,
+        'measurement_batch': 0x04,
         'node_joining':     0x06,
         'node_leaving':     0x07,
         'node_alive':       0x08,
+        'route_error':      0x0c,
         'routing_request':  0x0d,
         'routing_response': 0x0e,
         'sync_time':        0x0f,
+        'fragment':         0x10,
     }
 
-    def __init__(self, type: int, message: bytes, source_address: int, destination_address: int, ttl=20, rssi=1):
+    # the send priority classes, control frames keep the network together and
+    # are send before the bulk data
+    PRIORITY_CONTROL = 0
+    PRIORITY_BULK = 1
+
+    CONTROL_TYPES = (
+        FRAME_TYPES['discovery'],
+        FRAME_TYPES['config'],
+        FRAME_TYPES['replication'],
+        FRAME_TYPES['node_joining'],
+        FRAME_TYPES['node_leaving'],
+        FRAME_TYPES['node_alive'],
+        FRAME_TYPES['route_error'],
+        FRAME_TYPES['routing_request'],
+        FRAME_TYPES['routing_response'],
+        FRAME_TYPES['sync_time'],
+    )
+
+    # type, source address, destination address, sequence number, ttl and hops
+    HEADER_SIZE = 8
+
+    # the amount of times a frame can be forwarded
+    DEFAULT_TTL = 20
+
+    def __init__(self, type: int, message: bytes, source_address: int, destination_address: int, ttl=DEFAULT_TTL,
+                 rssi=1, sequence=0, hops=0):
         self.type = type
         self.source_address = source_address
         self.destination_address = destination_address
-        self.ttl = ttl
         self.rssi = rssi
 
+        # numbered by the source, together with the source and type it identifies the frame
+        self.sequence = sequence
+
+        # every node that forwards the frame lowers the ttl and raises the hops,
+        # a frame with a ttl of 0 is not forwarded anymore
+        self.ttl = ttl
+        self.hops = hops
+
         self.data = message
 
+    def derive(self, type: int, message: bytes):
+        """ a frame with the same source, destination, sequence number, ttl and hops but another type and data """
+        return Frame(type, message, self.source_address, self.destination_address, self.ttl, self.rssi,
+                     self.sequence, self.hops)
+
+    def forward(self) -> bool:
+        """ account the hop to the next node, returns false when the ttl ran out """
+        if self.ttl <= 0:
+            return False
+
+        self.ttl -= 1
+        self.hops += 1
+        return True
+
+    @property
+    def distance(self) -> int:
+        """ the amount of nodes the frame went through to get to us, 1 for a neighbour """
+        return self.hops + 1
+
     def serialize(self) -> bytes:
         return b''.join([
             self.type.to_bytes(1, 'big'),
             self.source_address.to_bytes(2, 'big'),
             self.destination_address.to_bytes(2, 'big'),
+            self.sequence.to_bytes(1, 'big'),
+            self.ttl.to_bytes(1, 'big'),
+            self.hops.to_bytes(1, 'big'),
             self.data
         ])
 
@@ -42,24 +114,71 @@ class Frame:
         type = frame[0]
         source_address = int.from_bytes(frame[1:3], 'big')
         destination_address = int.from_bytes(frame[3:5], 'big')
-        message = frame[5:]
+        sequence = frame[5]
+        ttl = frame[6]
+        hops = frame[7]
+        message = frame[8:]
 
-        return Frame(type, message, source_address, destination_address, rssi=rssi)
+        return Frame(type, message, source_address, destination_address, ttl, rssi, sequence, hops)
+
+    @staticmethod
+    def priority(type: int) -> int:
+        """ the send priority class of a frame type """
+        return Frame.PRIORITY_CONTROL if type in Frame.CONTROL_TYPES else Frame.PRIORITY_BULK
 
 
 class INetworkController:
-    """ the abstract base class for all network controllers """
+    """ the abstract base class for all network controllers.
+
+        the frames are send by a separate thread, `send_message` puts them in a
+        bounded SendQueue and wakes up the thread. the queue sends the control
+        frames first (see Frame.priority) and shares the rest between our own
+        and the forwarded frames by `forward_weights`.
+
+        a frame larger than `max_frame_size` bytes is split into fragments by
+        `_packets`, the node it is addressed to puts it back together.
+
+        every frame we send gets the next sequence number. forwarded frames
+        keep their source and sequence number, so a frame that is received
+        again (over another path or from a node forwarding it) is recognised
+        by the SeenCache and dropped.
+
+        the callbacks of every frame type, with the callbacks for all frames
+        (-1) in front, are kept in a dispatch table indexed by the frame type.
+        it is rebuilt when callbacks are registered. with `profile_callbacks`
+        the calls and time spent in every callback are counted, see
+        `callback_report`.
+    """
 
     task: asyncio.Task
     callbacks: dict[int, list]
-    queue: list = []
+    queue: SendQueue
     crc: CRC
 
-    def __init__(self):
+    # the largest serialized frame that fits in a single packet, None is unlimited
+    max_frame_size: int | None = None
+
+    def __init__(self, queue_capacity: int = 32, drop_policy: int = SendQueue.DROP_OLDEST,
+                 forward_weights: tuple[int, int] = (1, 1), seen_size: int = 64, profile_callbacks: bool = False):
         self.callbacks = {}
-        self.queue = []
+
+        # frame type -> callbacks, frame types past the end only have the callbacks for all frames
+        self.dispatch: list[tuple] = []
+        self.dispatch_all: tuple = ()
+
+        # callback -> [calls, total time in us]
+        self.callback_stats: dict | None = {} if profile_callbacks else None
+        self.queue = SendQueue(queue_capacity, drop_policy, weights=forward_weights)
         self.crc = CRC()
 
+        self.fragmenter = Fragmenter(Frame.FRAME_TYPES['fragment'])
+        self.reassembler = Reassembler()
+
+        # the asyncio loop and the send thread (route answers and repairs) both send frames
+        self.sequence = 0
+        self.sequence_lock = _thread.allocate_lock()
+        self.seen = SeenCache(seen_size)
+
     def start(self):
         """ start the network controller """
         loop = asyncio.get_event_loop()
@@ -68,47 +187,115 @@ class INetworkController:
         self.thread = _thread.start_new_thread(self._thread, ())
 
     killed = False
+    stopped = False
 
     def _thread(self):
-        while True and not self.killed:
-            if len(self.queue) > 0:
-                type, message, addr = self.queue.pop(0)
-                self._send_message(type, message, addr)
-            else:
-                time.sleep(0.001)
-
-    def _send_message(self, type: int, message: bytes, addr):
-        """ send a message to the specified address """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                # the frames put in the queue before stop are send first
+                if self.killed:
+                    break
+
+                # sleep until send_message or stop wakes us up
+                self.queue.wait()
+                continue
+
+            self._send_message(item)
+
+        self.stopped = True
+
+    def _send_message(self, frame: Frame):
+        """ send a frame to its destination """
         raise NotImplementedError()
 
     def _decode_message(self, message: bytes):
         return Frame.deserialize(message)
 
+    def _packets(self, frame: Frame, max_size: int | None = None) -> list[bytes]:
+        """ serialize the frame, split into fragments when it is larger than max_size or `max_frame_size` """
+        return self.fragmenter.split(frame, self.max_frame_size if max_size is None else max_size)
+
     async def _start(self):
         """ the main loop of the network controller """
         raise NotImplementedError()
 
-    def stop(self):
-        """ stop the network controller """
+    def stop(self, timeout: float = 0):
+        """ stop the network controller. the send thread sends the frames that
+            are still in the queue before it stops, wait at most timeout seconds
+            for that
+        """
         self.task.cancel()
         self.killed = True
+        self.queue.wake()
+
+        deadline = time() + timeout
+        while not self.stopped and time() < deadline:
+            sleep(0.01)
 
-    def send_message(self, type: int, message: bytes, addr=0xffff):
-        """ send a message to the specified address """
-        self.queue.append((type, message, addr))
+    def send_message(self, type: int, message: bytes, addr=0xffff, forwarded=False, ttl=Frame.DEFAULT_TTL, hops=0):
+        """ send a message to the specified address, forwarded is set for frames of other nodes we pass along.
+            a node that sends a frame on behalf of a frame it received passes the ttl and hops of that frame
+        """
+        with self.sequence_lock:
+            self.sequence = (self.sequence + 1) % 256
+            sequence = self.sequence
+
+        self.send_frame(Frame(type, message, self.address, addr, ttl, sequence=sequence, hops=hops), forwarded)
+
+    def send_frame(self, frame: Frame, forwarded=False):
+        """ put a frame on the send queue as it is """
+        # a forwarded fragment gets the priority of the frame it is a part of
+        frame_type = frame.type
+        if frame_type == Frame.FRAME_TYPES['fragment']:
+            frame_type = Fragmenter.inner_type(frame)
+
+        if not self.queue.put(frame, Frame.priority(frame_type), forwarded):
+            logger('send queue is full, dropped a frame', channel='warning')
 
     def register_callback(self, addr: int, callback):
         """ register a callback for the specified address """
-        if addr not in self.callbacks:
-            self.callbacks[addr] = []
-
-        self.callbacks[addr].append(callback)
+        self._add_callback(addr, callback)
+        self._build_dispatch()
 
     def register_callbacks(self, callbacks: dict[int, list]):
         """ register multiple callbacks """
         for frame_type in callbacks.keys():
             for callback in callbacks[frame_type]:
-                self.register_callback(frame_type, callback)
+                self._add_callback(frame_type, callback)
+
+        self._build_dispatch()
+
+    def _add_callback(self, addr: int, callback):
+        if addr not in self.callbacks:
+            self.callbacks[addr] = []
+
+        self.callbacks[addr].append(callback)
+
+    def _build_dispatch(self):
+        """ rebuild the dispatch table from the registered callbacks """
+        self.dispatch_all = tuple(self.callbacks.get(-1, []))
+
+        size = max([frame_type + 1 for frame_type in self.callbacks.keys()] + [0])
+        dispatch = [self.dispatch_all] * size
+        for frame_type, callbacks in self.callbacks.items():
+            if frame_type >= 0:
+                dispatch[frame_type] = self.dispatch_all + tuple(callbacks)
+
+        self.dispatch = dispatch
+
+    def callback_report(self) -> list[tuple[str, int, int]]:
+        """ the name, amount of calls and total time in us of every callback, the slowest first """
+        if self.callback_stats is None:
+            return []
+
+        report = [(self._callback_name(callback), calls, total)
+                  for callback, (calls, total) in self.callback_stats.items()]
+        return sorted(report, key=lambda r: r[2], reverse=True)
+
+    @staticmethod
+    def _callback_name(callback) -> str:
+        return callback.__name__ if hasattr(callback, '__name__') else str(callback)
 
     def on_message(self, message: bytes):
         """ called when a message is received """
@@ -118,34 +305,67 @@ class INetworkController:
             logger(f"Failed to decode message [{message}]", channel='error')
             return None
 
-        if frame.type not in [Frame.FRAME_TYPES['routing_request'], Frame.FRAME_TYPES['routing_response']] and frame.destination_address != self.address and frame.destination_address != 0xffff:
-            logger(
-                f'Got data for a different node, ignoring and pushing on queue', channel='routing')
-            self.send_message(frame.type, frame.data, frame.destination_address)
+        # our own frames forwarded back to us, or a frame we already received.
+        # every fragment of a frame has the same sequence number
+        key = (frame.source_address, frame.type, frame.sequence)
+        if frame.type == Frame.FRAME_TYPES['fragment']:
+            key = key + (Fragmenter.index(frame),)
+
+        if frame.source_address == self.address or self.seen.seen(key):
+            return None
+
+        # fragments are forwarded as they are, only the nodes that handle the
+        # frame put it back together
+        frame_type = frame.type
+        if frame_type == Frame.FRAME_TYPES['fragment']:
+            frame_type = Fragmenter.inner_type(frame)
+
+        if frame_type not in [Frame.FRAME_TYPES['routing_request'], Frame.FRAME_TYPES['routing_response']] and frame.destination_address != self.address and frame.destination_address != 0xffff:
+            if not frame.forward():
+                if logger.enabled('routing'):
+                    logger(f'Dropped a frame for {frame.destination_address}, its ttl ran out', channel='routing')
+                return
+
+            logger('Got data for a different node, ignoring and pushing on queue', channel='routing')
+            self.send_frame(frame, forwarded=True)
             return
 
+        if frame.type == Frame.FRAME_TYPES['fragment']:
+            data = self.reassembler.add(frame)
+            if data is None:
+                return
+
+            # the inner frame has the ttl and hops of when it was split, the
+            # fragments counted the hops on the way
+            fragment = frame
+            frame = Frame.deserialize(data, fragment.rssi)
+            frame.ttl = fragment.ttl
+            frame.hops = fragment.hops
+
         # Don't allow direct messaging between some nodes.
         # if self.address != 0x00a2 and frame.source_address != 0x00a2:
         #     return
 
         # call all the callbacks
-        for callback in self.callbacks.get(-1, []):
-            try:
-                callback(frame)
-            except Exception as e:
-                callback_name = callback.__name__ if hasattr(
-                    callback, '__name__') else callback
-                logger(
-                    f'error in callback {callback_name} with message {frame}: {e}', channel='error')
+        dispatch = self.dispatch
+        callbacks = dispatch[frame.type] if frame.type < len(dispatch) else self.dispatch_all
+        stats = self.callback_stats
+
+        for callback in callbacks:
+            if stats is not None:
+                start = ticks_us()
 
-        for callback in self.callbacks.get(frame.type, []):
             try:
                 callback(frame)
             except Exception as e:
-                callback_name = callback.__name__ if hasattr(
-                    callback, '__name__') else callback
                 logger(
-                    f'error in callback {callback_name} with message {frame}: {e}', channel='error')
+                    f'error in callback {self._callback_name(callback)} with message {frame}: {e}', channel='error')
+
+            if stats is not None:
+                if callback not in stats:
+                    stats[callback] = [0, 0]
+                stats[callback][0] += 1
+                stats[callback][1] += ticks_diff(ticks_us(), start)
 
     @property
     def address(self) -> int:
@@ -0,0 +1,35 @@
+class SeenCache:
+    """
+        remember the last `size` frames we received to drop duplicates.
+
+        in a mesh the same frame reaches a node over multiple paths and nodes
+        forward what they receive, every copy would be handled and forwarded
+        again. the frames are identified by their source, type and sequence
+        number. the keys are kept in a ring so the oldest one is forgotten
+        when a new one comes in, the set makes the lookup O(1).
+    """
+
+    def __init__(self, size: int = 64):
+        self.size = size
+        self.ring: list = [None] * size
+        self.position = 0
+        self.keys = set()
+
+        # metrics
+        self.duplicates = 0
+
+    def seen(self, key) -> bool:
+        """ check if the key was seen before, a new key is remembered """
+        if key in self.keys:
+            self.duplicates += 1
+            return True
+
+        oldest = self.ring[self.position]
+        if oldest is not None:
+            self.keys.discard(oldest)
+
+        self.ring[self.position] = key
+        self.position = (self.position + 1) % self.size
+        self.keys.add(key)
+
+        return False
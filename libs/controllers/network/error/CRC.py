@@ -1,11 +1,34 @@
-from libs.external.reedsolo import *
+from libs.external.reedsolo import ReedSolomonError
+from libs.controllers.network.error.ReedSolomon import ReedSolomon
 
 import array
 
 
 class CRC:
+    """
+        add a crc and reed solomon symbols to a packet.
+
+        the amount of reed solomon symbols, the strength, is chosen per packet
+        from STRENGTHS. it is send in front of the codeword as a byte with the
+        strength in both nibbles, so a corrupted strength is recognised.
+    """
+
+    # the amounts of reed solomon symbols a packet can be encoded with
+    STRENGTHS = (2, 5, 8, 12)
+    DEFAULT_STRENGTH = 5
+
+    # the strength byte and 2 crc bytes, on top of the reed solomon symbols
+    HEADER_SIZE = 1
+    CHECKSUM_SIZE = 2
+
+    # the most bytes encode adds, with the strongest strength
+    OVERHEAD = HEADER_SIZE + CHECKSUM_SIZE + max(STRENGTHS)
+
     def __init__(self):
-        self.corrector = RSCodec(5)
+        self.corrector = ReedSolomon(self.STRENGTHS)
+
+        # the amount of symbols corrected in the last decoded packet
+        self.errors = 0
         self.table = array.array("H", [CRC.table(i) for i in range(256)])
 
     @staticmethod
@@ -29,14 +52,27 @@ class CRC:
     def verify(self, data: bytes, checksum: bytes) -> bool:
         return self.checksum(data) == checksum
 
-    def encode(self, data: bytes) -> bytearray:
+    @staticmethod
+    def overhead(strength: int) -> int:
+        """ the amount of bytes encode adds with the strength """
+        return CRC.HEADER_SIZE + CRC.CHECKSUM_SIZE + strength
+
+    def encode(self, data: bytes, strength: int = DEFAULT_STRENGTH) -> bytearray:
         combine = data + self.checksum(data)
 
-        return self.corrector.encode(combine)
+        return bytearray([strength | strength << 4]) + self.corrector.encode(combine, strength)
 
     def decode(self, frame: bytes) -> bytearray | None:
+        self.errors = 0
+        if len(frame) < 1:
+            return None
+
+        strength = frame[0] & 0x0f
+        if frame[0] >> 4 != strength or strength not in self.STRENGTHS:
+            return None
+
         try:
-            decoded = self.corrector.decode(frame)[0]
+            decoded, self.errors = self.corrector.decode(frame[1:], strength)
 
             crc = decoded[-2:]
             data = decoded[:-2]
@@ -46,7 +82,7 @@ class CRC:
             else:
                 return None
 
-        except reedsolo.ReedSolomonError:
+        except ReedSolomonError:
             return None
 
 # # Testing
@@ -0,0 +1,85 @@
+from libs.controllers.network.error.CRC import CRC
+
+from time import time
+import _thread
+
+
+class LinkQuality:
+    """
+        choose the reed solomon strength of the packets we send to every neighbour.
+
+        the rssi and the amount of symbols the reed solomon code corrected are
+        kept as a moving average for every neighbour, from the frames it send
+        us itself (hops 0). the rssi picks the strength from RSSI_STRENGTHS, a
+        link where the corrections use more than half of what that strength
+        can correct gets the next stronger one. a clean link spends less
+        airtime on symbols and a bad link gets enough to avoid losing frames.
+
+        broadcasts are encoded for the weakest neighbour. neighbours we did
+        not hear from in `timeout` seconds get the default strength.
+
+        the links are updated by the main loop and read by the send thread,
+        the lock guards them.
+    """
+
+    # the lowest rssi in dBm a strength is used for, weakest strength first
+    RSSI_STRENGTHS = ((-80, 2), (-95, 5), (-105, 8))
+
+    def __init__(self, strengths: tuple = CRC.STRENGTHS, default: int = CRC.DEFAULT_STRENGTH,
+                 weight: float = 0.25, timeout: int = 600):
+        self.strengths = strengths
+        self.default = default
+        self.weight = weight
+        self.timeout = timeout
+
+        # address -> [rssi, corrected symbols, time of the last frame]
+        self.links: dict[int, list] = {}
+        self.lock = _thread.allocate_lock()
+
+    def update(self, address: int, rssi: int | None, errors: int):
+        """ account a frame the neighbour send us, rssi is None when the radio does not measure it """
+        with self.lock:
+            link = self.links.get(address)
+            if link is None:
+                self.links[address] = [rssi, errors, time()]
+                return
+
+            if rssi is not None:
+                link[0] = rssi if link[0] is None else link[0] + self.weight * (rssi - link[0])
+            link[1] += self.weight * (errors - link[1])
+            link[2] = time()
+
+    def strength(self, address: int) -> int:
+        """ the strength to encode the packets to the address with """
+        if address == 0xffff:
+            now = time()
+            with self.lock:
+                strengths = [self._strength(link) for link in self.links.values() if link[2] + self.timeout > now]
+            return max(strengths) if strengths else self.default
+
+        with self.lock:
+            link = self.links.get(address)
+            if link is None or link[2] + self.timeout < time():
+                return self.default
+
+            return self._strength(link)
+
+    def _strength(self, link: list) -> int:
+        rssi, errors, _ = link
+
+        strength = self.strengths[-1]
+        if rssi is None:
+            strength = self.default
+        else:
+            for threshold, candidate in self.RSSI_STRENGTHS:
+                if rssi >= threshold:
+                    strength = candidate
+                    break
+
+        # reed solomon corrects half as many errors as it has symbols
+        index = self.strengths.index(strength)
+        while errors > strength / 4 and index + 1 < len(self.strengths):
+            index += 1
+            strength = self.strengths[index]
+
+        return strength
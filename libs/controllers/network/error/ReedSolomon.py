@@ -0,0 +1,142 @@
+from libs.external.reedsolo import RSCodec, rs_generator_poly
+
+
+class ReedSolomon:
+    """
+        a reed solomon codec for a single chunk, with any of the amounts of ecc
+        symbols in `strengths`.
+
+        RSCodec works for any amount of symbols and builds new polynomials for
+        every message, on the board that is one of the slowest steps of every
+        frame. this codec makes the same codewords from tables:
+            - `generator[nsym][j][c]`: c times the j-th coefficient of the
+              generator polynomial, the encoder is a shift register over the
+              remainder
+            - `power[i][c]`: c times alpha^i, for the syndromes. the same for
+              every strength
+
+        the default strength of 5 symbols has its own unrolled loops.
+
+        almost every frame arrives without errors, the syndromes are all zero
+        and the message is returned as it is. only when there is an error the
+        frame is corrected by RSCodec (Berlekamp-Massey).
+    """
+
+    # the longest codeword in a single chunk
+    MAX_SIZE = 255
+
+    def __init__(self, strengths: tuple = (5,)):
+        self.strengths = strengths
+        self.corrector = RSCodec(max(strengths))
+        self.gf_log, self.gf_exp = self.corrector.gf_log, self.corrector.gf_exp
+
+        self.generator: dict[int, list[bytearray]] = {}
+        for nsym in strengths:
+            gen = rs_generator_poly(nsym)
+            self.corrector.gen[nsym] = gen
+            self.generator[nsym] = [self._multiplication_table(gen[j]) for j in range(1, nsym + 1)]
+
+        self.power = [self._multiplication_table(self.gf_exp[i]) for i in range(max(strengths))]
+
+        # preallocated remainder and syndromes
+        self.remainder = bytearray(max(strengths))
+        self.syndromes = bytearray(max(strengths))
+
+        # metrics
+        self.corrected = 0
+
+    def _multiplication_table(self, x: int) -> bytearray:
+        table = bytearray(256)
+        log_x = self.gf_log[x]
+        for c in range(1, 256):
+            table[c] = self.gf_exp[self.gf_log[c] + log_x]
+
+        return table
+
+    def encode(self, data: bytes, nsym: int) -> bytearray:
+        """ the data followed by nsym ecc symbols """
+        if len(data) + nsym > self.MAX_SIZE:
+            return self.corrector.encode(data, nsym)
+
+        if nsym == 5:
+            return self._encode5(data)
+
+        generator = self.generator[nsym]
+        last = nsym - 1
+        remainder = self.remainder
+        for j in range(nsym):
+            remainder[j] = 0
+
+        for c in data:
+            coef = c ^ remainder[0]
+            for j in range(last):
+                remainder[j] = remainder[j + 1] ^ generator[j][coef]
+            remainder[last] = generator[last][coef]
+
+        codeword = bytearray(len(data) + nsym)
+        codeword[:len(data)] = data
+        codeword[len(data):] = remainder[:nsym]
+
+        return codeword
+
+    def _encode5(self, data: bytes) -> bytearray:
+        g0, g1, g2, g3, g4 = self.generator[5]
+        r0 = r1 = r2 = r3 = r4 = 0
+        for c in data:
+            coef = c ^ r0
+            r0 = r1 ^ g0[coef]
+            r1 = r2 ^ g1[coef]
+            r2 = r3 ^ g2[coef]
+            r3 = r4 ^ g3[coef]
+            r4 = g4[coef]
+
+        codeword = bytearray(len(data) + 5)
+        codeword[:len(data)] = data
+        codeword[len(data):] = bytes([r0, r1, r2, r3, r4])
+
+        return codeword
+
+    def check(self, codeword: bytes, nsym: int) -> bool:
+        """ check if all the syndromes of the codeword are zero """
+        if nsym == 5:
+            return self._check5(codeword)
+
+        power = self.power
+        syndromes = self.syndromes
+        for i in range(nsym):
+            syndromes[i] = 0
+
+        for c in codeword:
+            for i in range(nsym):
+                syndromes[i] = power[i][syndromes[i]] ^ c
+
+        for i in range(nsym):
+            if syndromes[i]:
+                return False
+
+        return True
+
+    def _check5(self, codeword: bytes) -> bool:
+        p1, p2, p3, p4 = self.power[1:5]
+        s0 = s1 = s2 = s3 = s4 = 0
+        for c in codeword:
+            s0 ^= c
+            s1 = p1[s1] ^ c
+            s2 = p2[s2] ^ c
+            s3 = p3[s3] ^ c
+            s4 = p4[s4] ^ c
+
+        return not (s0 | s1 | s2 | s3 | s4)
+
+    def decode(self, codeword: bytes, nsym: int) -> tuple[bytes, int]:
+        """ the message without the ecc symbols and the amount of corrected symbols,
+            raises ReedSolomonError when it can not be corrected
+        """
+        if len(codeword) <= self.MAX_SIZE and self.check(codeword, nsym):
+            return codeword[:-nsym], 0
+
+        message, _, errata = self.corrector.decode(codeword, nsym)
+        if errata:
+            self.corrected += 1
+
+        return message, len(errata)
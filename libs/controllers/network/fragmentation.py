@@ -0,0 +1,130 @@
+from time import time
+
+
+class Fragmenter:
+    """
+        split frames that do not fit in a single radio packet into fragments.
+
+        a fragment is a frame of the `fragment` type, its data is a header
+        followed by a piece of the serialized frame:
+            - 2 bytes: source address of the fragmented frame
+            - 1 byte: type of the fragmented frame
+            - 1 byte: sequence number of the fragmented frame
+            - 1 byte: index of the fragment
+            - 1 byte: amount of fragments
+
+        the address and type are in every fragment, so nodes in between can
+        forward the fragments without putting the frame back together. the
+        fragments keep the source, destination and sequence number of the frame.
+
+        a fragment is never split again, its pieces would have the same source,
+        sequence number and index. the origin has to split the frame at a size
+        every node on the route can send as it is.
+    """
+
+    HEADER_SIZE = 6
+
+    def __init__(self, fragment_type: int):
+        self.fragment_type = fragment_type
+
+    def split(self, frame, max_size: int | None) -> list[bytes]:
+        """ serialize the frame into one or more packets of at most max_size bytes """
+        data = frame.serialize()
+        if max_size is None or len(data) <= max_size or frame.type == self.fragment_type:
+            return [data]
+
+        chunk_size = max_size - frame.HEADER_SIZE - self.HEADER_SIZE
+        count = (len(data) + chunk_size - 1) // chunk_size
+        if count > 255:
+            raise ValueError(f'frame of {len(data)} bytes is too large to fragment')
+
+        packets = []
+        for i in range(count):
+            header = b''.join([
+                frame.source_address.to_bytes(2, 'big'),
+                frame.type.to_bytes(1, 'big'),
+                frame.sequence.to_bytes(1, 'big'),
+                i.to_bytes(1, 'big'),
+                count.to_bytes(1, 'big'),
+            ])
+            chunk = data[i * chunk_size:(i + 1) * chunk_size]
+            packets.append(frame.derive(self.fragment_type, header + chunk).serialize())
+
+        return packets
+
+    @staticmethod
+    def inner_type(frame) -> int:
+        """ the type of the frame a fragment is a part of """
+        return frame.data[2]
+
+    @staticmethod
+    def index(frame) -> int:
+        """ the index of a fragment in the frame it is a part of """
+        return frame.data[4]
+
+
+class Reassembler:
+    """
+        put fragmented frames back together.
+
+        the fragments are collected per (source address, sequence number) of
+        the fragmented frame. a frame that is not complete within
+        `timeout` seconds is dropped, as are the oldest incomplete frames when
+        more than `max_bytes` bytes of fragments are kept.
+    """
+
+    def __init__(self, timeout: int = 30, max_bytes: int = 2048):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+        # (address, sequence) -> [time of the first fragment, fragments]
+        self.buffers: dict[tuple[int, int], list] = {}
+        self.size = 0
+
+    def add(self, frame) -> bytes | None:
+        """ add a fragment, returns the serialized frame once all its fragments are received """
+        self._expire()
+
+        header = frame.data[:Fragmenter.HEADER_SIZE]
+        key = (int.from_bytes(header[0:2], 'big'), header[3])
+        index, count = header[4], header[5]
+        chunk = frame.data[Fragmenter.HEADER_SIZE:]
+
+        if key not in self.buffers:
+            self.buffers[key] = [time(), [None] * count]
+
+        fragments = self.buffers[key][1]
+        if index >= len(fragments) or fragments[index] is not None:
+            return None
+
+        fragments[index] = chunk
+        self.size += len(chunk)
+
+        if None not in fragments:
+            self._drop(key)
+            return b''.join(fragments)
+
+        # keep the newest frames when there are too many fragments
+        while self.size > self.max_bytes:
+            self._drop(self._oldest())
+
+        return None
+
+    def _oldest(self) -> tuple[int, int]:
+        oldest = None
+        for key, (started, _) in self.buffers.items():
+            if oldest is None or started < self.buffers[oldest][0]:
+                oldest = key
+
+        return oldest
+
+    def _drop(self, key: tuple[int, int]):
+        _, fragments = self.buffers.pop(key)
+        for chunk in fragments:
+            if chunk is not None:
+                self.size -= len(chunk)
+
+    def _expire(self):
+        now = time()
+        for key in [key for key, (started, _) in self.buffers.items() if started + self.timeout < now]:
+            self._drop(key)
@@ -0,0 +1,157 @@
+import _thread
+
+
+class _Ring:
+    """ a fixed size FIFO ring buffer, the caller does the locking """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffer = [None] * capacity
+        self.head = 0
+        self.depth = 0
+
+    def full(self) -> bool:
+        return self.depth == self.capacity
+
+    def put(self, item):
+        self.buffer[(self.head + self.depth) % self.capacity] = item
+        self.depth += 1
+
+    def get(self):
+        item = self.buffer[self.head]
+        self.buffer[self.head] = None
+        self.head = (self.head + 1) % self.capacity
+        self.depth -= 1
+
+        return item
+
+
+class SendQueue:
+    """
+        bounded ring buffers of frames waiting to be send, one for every
+        priority class and origin (our own frames or forwarded frames).
+
+        the asyncio loop puts frames in the queue and the send thread takes them
+        out, both in O(1). the buffers are guarded by a lock because the send
+        thread runs on the other core. when the queue is empty the send thread
+        blocks on the `wakeup` lock until a frame is put in the queue, instead
+        of polling.
+
+        a frame of a lower priority class is only send when all higher classes
+        are empty. within a class our own and the forwarded frames take turns
+        by `weights`, with the default (1, 1) every other frame is forwarded
+        while both have frames waiting. frames of the same class and origin are
+        send in the order they were put in the queue.
+
+        every buffer holds `capacity` frames. when one is full the drop policy
+        decides which frame is lost:
+            - DROP_OLDEST: the frame that waited the longest is dropped
+            - DROP_NEWEST: the new frame is not added
+
+        for the metrics `depth` is the current amount of frames in the queue,
+        `high_water` the highest depth seen and `dropped` the amount of frames
+        lost because a buffer was full.
+    """
+
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+
+    def __init__(self, capacity: int = 32, drop_policy: int = DROP_OLDEST, classes: int = 2,
+                 weights: tuple[int, int] = (1, 1)):
+        self.capacity = capacity
+        self.drop_policy = drop_policy
+        self.weights = weights
+
+        # class -> [own, forwarded]
+        self.rings = [[_Ring(capacity), _Ring(capacity)] for _ in range(classes)]
+        # class -> position in the round of the weighted round robin
+        self.turns = [0] * classes
+        self.depth = 0
+
+        self.lock = _thread.allocate_lock()
+
+        # locked while the queue is empty, the send thread waits on it
+        self.wakeup = _thread.allocate_lock()
+        self.wakeup.acquire()
+
+        # metrics
+        self.high_water = 0
+        self.enqueued = 0
+        self.dropped = 0
+
+    def put(self, item, priority: int = 0, forwarded: bool = False) -> bool:
+        """ add an item to the queue, returns false when an item had to be dropped """
+        ring = self.rings[priority][1 if forwarded else 0]
+
+        with self.lock:
+            added = True
+
+            if ring.full():
+                self.dropped += 1
+                added = False
+
+                if self.drop_policy == self.DROP_NEWEST:
+                    return False
+
+                # make room by dropping the oldest item
+                ring.get()
+                self.depth -= 1
+
+            ring.put(item)
+            self.depth += 1
+            self.enqueued += 1
+
+            if self.depth > self.high_water:
+                self.high_water = self.depth
+
+            self._wake()
+
+        return added
+
+    def get(self):
+        """ take the next item out of the queue, None when it is empty """
+        with self.lock:
+            if self.depth == 0:
+                return None
+
+            for priority, (own, forwarded) in enumerate(self.rings):
+                if own.depth == 0 and forwarded.depth == 0:
+                    continue
+
+                # the first weights[0] turns of a round are for our own frames,
+                # when the preferred buffer is empty the other one is used
+                turn = self.turns[priority]
+                self.turns[priority] = (turn + 1) % (self.weights[0] + self.weights[1])
+
+                ring = own if turn < self.weights[0] else forwarded
+                if ring.depth == 0:
+                    ring = forwarded if ring is own else own
+
+                self.depth -= 1
+                return ring.get()
+
+    def wait(self):
+        """ block until an item is put in the queue (or `wake` is called) """
+        self.wakeup.acquire()
+
+    def wake(self):
+        """ wake up the thread waiting on the queue """
+        with self.lock:
+            self._wake()
+
+    def _wake(self):
+        # the caller holds the lock, so no other thread can release it between
+        # the check and the release. only the waiting thread locks it again
+        if self.wakeup.locked():
+            self.wakeup.release()
+
+    def __len__(self):
+        return self.depth
+
+    def metrics(self) -> dict:
+        return {
+            'depth': self.depth,
+            'high_water': self.high_water,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,131 @@
+from time import time
+import _thread
+import heapq
+
+
+class RouteCache:
+    """
+        the next hop to every node we know a route to.
+
+        a route expires `timeout` seconds after it was last used, using it
+        (`get`) keeps it alive, so an active flow never has to find its route
+        again. when `max_size` routes are known the least recently used one
+        makes room for a new one.
+
+        both the expiry and the eviction take the route with the oldest last
+        use, they share a heap of (last use, address). a use pushes a new item
+        instead of updating the old one, an item whose time is not the last use
+        of its route anymore is skipped when it is popped. expiring is
+        O(expired log n), the heap is rebuilt when it holds too many of those
+        stale items.
+
+        the routes are used by the send thread and learned by the main loop,
+        the lock guards them.
+    """
+
+    def __init__(self, timeout: int = 30, max_size: int = 32):
+        self.timeout = timeout
+        self.max_size = max_size
+
+        # address -> [next hop, last use, time the route was learned]
+        self.entries: dict[int, list] = {}
+        self.heap: list[tuple] = []
+        self.lock = _thread.allocate_lock()
+
+        # metrics
+        self.evicted = 0
+        self.expired = 0
+
+    def __contains__(self, address: int) -> bool:
+        return address in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, address: int) -> int | None:
+        """ the next hop to the address, None when there is no route. refreshes the route """
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry is None:
+                return None
+
+            self._use(address, entry, time())
+            return entry[0]
+
+    def put(self, address: int, hop: int):
+        """ learn or replace the route to the address """
+        now = time()
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry is not None:
+                entry[0] = hop
+                entry[2] = now
+                self._use(address, entry, now)
+                return
+
+            while len(self.entries) >= self.max_size and self._pop() is not None:
+                self.evicted += 1
+
+            entry = [hop, now, now]
+            self.entries[address] = entry
+            heapq.heappush(self.heap, (now, address))
+
+    def next_hop(self, address: int) -> int | None:
+        """ the next hop to the address without refreshing the route """
+        entry = self.entries.get(address)
+        return None if entry is None else entry[0]
+
+    def via(self, hop: int) -> list[int]:
+        """ the addresses of the routes that go through hop """
+        with self.lock:
+            return [address for address, entry in self.entries.items() if entry[0] == hop]
+
+    def remove(self, address: int) -> int | None:
+        """ forget the route to the address, returns its next hop. its heap items go stale """
+        with self.lock:
+            entry = self.entries.pop(address, None)
+
+        return None if entry is None else entry[0]
+
+    def age(self, address: int) -> float:
+        """ the seconds since the route to the address was learned """
+        entry = self.entries.get(address)
+        return 0 if entry is None else time() - entry[2]
+
+    def expire(self) -> list[int]:
+        """ forget the routes that were not used for `timeout` seconds, returns their addresses """
+        expired = []
+        deadline = time() - self.timeout
+        with self.lock:
+            while self.heap and self.heap[0][0] < deadline:
+                used, address = heapq.heappop(self.heap)
+                entry = self.entries.get(address)
+                if entry is not None and entry[1] == used:
+                    del self.entries[address]
+                    expired.append(address)
+
+        self.expired += len(expired)
+        return expired
+
+    def _use(self, address: int, entry: list, now):
+        if entry[1] == now:
+            return
+
+        entry[1] = now
+        heapq.heappush(self.heap, (now, address))
+
+        # too many stale items, keep one for every route
+        if len(self.heap) > 4 * self.max_size:
+            self.heap = [(route[1], destination) for destination, route in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def _pop(self) -> int | None:
+        """ remove the least recently used route, returns its address. None when only stale items were left """
+        while self.heap:
+            used, address = heapq.heappop(self.heap)
+            entry = self.entries.get(address)
+            if entry is not None and entry[1] == used:
+                del self.entries[address]
+                return address
+
+        return None
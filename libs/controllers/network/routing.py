@@ -1,27 +1,108 @@
 from libs.controllers.network import Frame, INetworkController
 from libs.controllers.neighbours import NeighboursController
+from libs.controllers.network.duplicates import SeenCache
+from libs.controllers.network.routes import RouteCache
 from libs.external.ChannelLogger import logger
 from time import time
+import _thread
 import asyncio
 
 
 class RoutingController:
-    def __init__(self, neighbours: NeighboursController, network: INetworkController) -> None:
+    """ Finds the routes to the nodes that are not our neighbours.
+
+        A route request is flooded through the network, every node it passes
+        adds a hop to it with the rssi of the link the request came in over
+        and the depth of its send queue:
+            - 1 byte: id of the request, numbered by the origin
+            - for the origin and every hop:
+                - 2 bytes: address
+                - 1 byte: rssi in dBm as a signed byte, 0 for the origin
+                - 1 byte: amount of frames in the send queue
+
+        The destination collects the requests that come in over different
+        paths for `window` seconds and answers the one with the lowest cost
+        (see `cost`), instead of the first one that arrived. A route that is
+        used after `refresh` of its lifetime is requested again while the
+        old route is still used, so a sustained flow moves over to a better
+        path and never waits for a new route.
+
+        The routes live in a RouteCache, a route that is used does not expire.
+
+        When a neighbour that is the next hop of routes is gone, or a node has
+        no route for a frame it forwards, the node repairs the route itself
+        with a route request of `repair_ttl` hops. When that gets no response
+        in `repair_timeout` seconds it broadcasts a route error with the
+        addresses it can not reach anymore (2 bytes each). The nodes that
+        route to those addresses through it forget those routes and pass the
+        error on, up to the origins, which flood a new request on the next
+        frame.
+    """
+
+    # The bytes of the request id and of every hop in a route request
+    REQUEST_HEADER_SIZE = 1
+    HOP_SIZE = 4
+
+    # The rssi in dBm from which a link counts as good
+    GOOD_RSSI = -80
+
+    def __init__(self, neighbours: NeighboursController, network: INetworkController,
+                 max_parked_bytes: int = 2048, max_routes: int = 32, window: float = 1, refresh: float = 0.75,
+                 hop_weight: float = 1, rssi_weight: float = 0.1, queue_weight: float = 0.25,
+                 repair_ttl: int = 3, repair_timeout: int = 5) -> None:
         self.neighbours = neighbours
         self.network = network
 
         # Time a request lives in seconds
         self.timeout = 30
 
+        self.window = window
+        self.refresh = refresh
+
+        self.repair_ttl = repair_ttl
+        self.repair_timeout = repair_timeout
+
+        # The weights of the cost of a route
+        self.hop_weight = hop_weight
+        self.rssi_weight = rssi_weight
+        self.queue_weight = queue_weight
+
+        # The id of the last route request we send
+        self.request_id = 0
+
+        # The route requests we forwarded, (origin, destination, id). the
+        # send thread requests routes while the main loop forwards requests
+        self.requests = SeenCache(32)
+        self.requests_lock = _thread.allocate_lock()
+
+        # (origin, id) -> [time of the first request, cost, route], the
+        # routes to us that came in, the route is None once it is answered
+        self.candidates: dict[tuple[int, int], list] = {}
+
         # Address -> next hop
-        self.routing_table: dict[int, int] = {}
+        self.routes = RouteCache(self.timeout, max_routes)
+
+        # Address -> time we requested a route to it, the requests waiting
+        # for a response
+        self.pending: dict[int, int] = {}
+
+        # Address -> time the local repair started, a subset of pending
+        self.repairs: dict[int, int] = {}
 
-        # Address -> time we got it
-        self.request_list: dict[int, int] = {}
+        # The send thread requests routes, the main loop gets the responses
+        self.pending_lock = _thread.allocate_lock()
+
+        # Address -> [(time parked, frame)], the frames waiting for a
+        # route. they are parked by the send thread and released by the
+        # routing response, so the lock guards them
+        self.parked: dict[int, list] = {}
+        self.parked_bytes = 0
+        self.max_parked_bytes = max_parked_bytes
+        self.parked_lock = _thread.allocate_lock()
 
     def start(self):
-        """ Start up the clean up cycle, will delete all routes older than
-            `self.timeout`.
+        """ Start up the clean up cycle, will delete all routes that were not
+            used for `self.timeout`.
         """
         loop = asyncio.get_event_loop()
         self.task = loop.create_task(self._start())
@@ -30,42 +111,205 @@ class RoutingController:
         """ Clean up cycle
         """
         while True:
-            # The current list is empty, might aswell wait for it clear up
-            if len(self.request_list) <= 0:
-                await asyncio.sleep(self.timeout)
-                continue
+            self._expire_parked()
+            self._expire_candidates()
+            self._expire_repairs()
+            self._expire_pending()
+
+            for address in self.routes.expire():
+                logger(f'Route to {address} expired', channel='routing')
+
+            await asyncio.sleep(min(self.timeout // 4, self.repair_timeout))
+
+    def park(self, frame: Frame) -> bool:
+        """ Keep a frame until a route to its destination is found, instead of
+            putting it back on the send queue. Returns False when the frame is
+            dropped because too many bytes are parked.
+        """
+        address = frame.destination_address
+        with self.parked_lock:
+            # The route came in between get_route and parking the frame
+            if address in self.routes:
+                self.network.send_frame(frame)
+                return True
+
+            if self.parked_bytes + len(frame.data) > self.max_parked_bytes:
+                logger(f'Too many frames waiting for a route, dropping a frame for {address}', channel='warning')
+                return False
+
+            self.parked.setdefault(address, []).append((time(), frame))
+            self.parked_bytes += len(frame.data)
+
+        return True
+
+    def _release(self, address: int):
+        """ Send the frames parked for address, in the order they were parked """
+        with self.parked_lock:
+            frames = self.parked.pop(address, [])
+            for _, frame in frames:
+                self.parked_bytes -= len(frame.data)
 
-            for i in self.request_list:
-                if self.request_list[i] + self.timeout < time():
-                    del self.request_list[i]
-                    if i in self.routing_table:
-                        del self.routing_table[i]
+        for _, frame in frames:
+            self.network.send_frame(frame)
 
-            await asyncio.sleep(self.timeout // 4)
+    def _expire_parked(self):
+        """ Drop the parked frames that waited longer than `self.timeout` for a route """
+        now = time()
+        with self.parked_lock:
+            for address in list(self.parked.keys()):
+                frames = self.parked[address]
+                while frames and frames[0][0] + self.timeout < now:
+                    self.parked_bytes -= len(frames.pop(0)[1].data)
 
-    def get_route(self, address: int) -> int:
+                if not frames:
+                    del self.parked[address]
+                    logger(f'No route found to {address}, dropped the parked frames', channel='routing')
+
+    def get_route(self, address: int, forwarding: bool = False) -> int:
         """ Find the route from this node to address, makes use of a modified
-            and simplified version of the AODV protocol.
+            and simplified version of the AODV protocol. forwarding is set for
+            the frames of other nodes, a missing route for those is repaired
+            locally.
 
             Returns either -1 if the route is still unkown, or the address of
             next hop when it is.
         """
         # Address found in the routing table
-        if address in self.routing_table:
-            return self.routing_table[address]
+        hop = self.routes.get(address)
+        if hop is not None:
+            # Look for a better route before this one gets old, the nodes
+            # sending the frames we forward refresh their own routes
+            if not forwarding and address not in self.pending and self.routes.age(address) > self.timeout * self.refresh:
+                self._request_route(address)
+
+            return hop
 
         # Address direct neighbour
         if address in self.neighbours.connections:
             return address
 
+        # Still waiting for the response
+        if address in self.pending:
+            return -1
+
+        if forwarding:
+            self._repair(address)
+        else:
+            self._request_route(address)
+
+        return -1
+
+    def _request_route(self, address: int, ttl: int = Frame.DEFAULT_TTL):
+        """ Flood a route request for address through at most ttl hops """
         logger(f'Sending route request for {address}', channel='routing')
+        with self.requests_lock:
+            self.request_id = (self.request_id + 1) % 256
+            request_id = self.request_id
+            self.requests.seen((self.network.address, address, request_id))
+
+        with self.pending_lock:
+            self.pending[address] = time()
+
         self.network.send_message(Frame.FRAME_TYPES['routing_request'], b''.join([
+            request_id.to_bytes(1, 'big'),
+            self._hop(0),
+        ]), address, ttl=ttl)
+
+    def _repair(self, address: int):
+        """ Look for a new route to address close by """
+        logger(f'Repairing the route to {address}', channel='routing')
+        with self.pending_lock:
+            self.repairs[address] = time()
+
+        self._request_route(address, self.repair_ttl)
+
+    def handle_neighbour_lost(self, neighbour: int):
+        """ Repair the routes that went through a neighbour that is gone """
+        for address in self.routes.via(neighbour):
+            self.routes.remove(address)
+            if address not in self.pending:
+                self._repair(address)
+
+    def _expire_repairs(self):
+        """ Give up on the repairs without a response, tell the nodes routing through us """
+        now = time()
+        with self.pending_lock:
+            failed = [address for address, started in self.repairs.items() if started + self.repair_timeout < now]
+            for address in failed:
+                del self.repairs[address]
+                self.pending.pop(address, None)
+
+        if not failed:
+            return
+
+        for address in failed:
+            with self.parked_lock:
+                for _, frame in self.parked.pop(address, []):
+                    self.parked_bytes -= len(frame.data)
+
+        self.send_route_error(failed)
+
+    def send_route_error(self, addresses: list[int]):
+        """ Broadcast that we have no route to the addresses anymore """
+        if logger.enabled('routing'):
+            logger(f'No route to {addresses} anymore, sending a route error', channel='routing')
+
+        self.network.send_message(
+            Frame.FRAME_TYPES['route_error'],
+            b''.join([address.to_bytes(2, 'big') for address in addresses]),
+        )
+
+    def handle_route_error(self, frame: Frame):
+        """ Handles a route error.
+            Forgets the routes to the addresses in the frame that go through
+            the node that send it, and passes the error on for those.
+        """
+        broken = []
+        for i in range(0, len(frame.data) - 1, 2):
+            address = int.from_bytes(frame.data[i:i + 2], 'big')
+            if self.routes.next_hop(address) == frame.source_address:
+                self.routes.remove(address)
+                broken.append(address)
+
+        if broken:
+            self.send_route_error(broken)
+
+    def _hop(self, rssi: int) -> bytes:
+        """ This node as a hop in a route request """
+        return b''.join([
             self.network.address.to_bytes(2, 'big'),
-            (0x00).to_bytes(1, 'big'),
-        ]), address)
-        self.routing_table[address] = -1
-        self.request_list[address] = time()
-        return -1
+            # two's complement, not every port supports signed to_bytes
+            (rssi & 0xff).to_bytes(1, 'big'),
+            min(len(self.network.queue), 0xff).to_bytes(1, 'big'),
+        ])
+
+    @staticmethod
+    def _hops(data: bytes) -> list[tuple[int, int, int]]:
+        """ The address, rssi and queue depth of every hop in a route request """
+        hops = []
+        for i in range(RoutingController.REQUEST_HEADER_SIZE, len(data), RoutingController.HOP_SIZE):
+            rssi = data[i + 2]
+            if rssi & 0x80:
+                rssi -= 0x100
+
+            hops.append((int.from_bytes(data[i:i + 2], 'big'), rssi, data[i + 3]))
+
+        return hops
+
+    def cost(self, hops: list[tuple[int, int, int]]) -> float:
+        """ The cost of a route, lower is better. Made up of the amount of
+            hops, how far the worst link is below GOOD_RSSI and the frames
+            waiting in the send queues along the route.
+
+            Radios without rssi report a positive rssi, those links count as
+            good.
+        """
+        links = [rssi for _, rssi, _ in hops[1:] if rssi <= 0]
+        worst = min(links) if links else 0
+
+        return (self.hop_weight * (len(hops) - 1)
+                + self.rssi_weight * max(0, self.GOOD_RSSI - worst)
+                + self.queue_weight * sum([queue for _, _, queue in hops]))
 
     def handle_routing_request(self, frame: Frame):
         """ Handles a route request.
@@ -77,49 +321,105 @@ class RoutingController:
             When it is neither of those cases it will re-broadcast the routing
             request.
         """
+        request_id = frame.data[0]
+        origin = int.from_bytes(frame.data[1:3], 'big')
+
+        if frame.destination_address == self.network.address:
+            # origin -> between nodes -> end node
+            self._add_candidate(origin, request_id, self._hops(frame.data + self._hop(frame.rssi)))
+            return
+
         # We have already had this request before recently, ignore.
-        if frame.destination_address in self.request_list:
+        with self.requests_lock:
+            seen = self.requests.seen((origin, frame.destination_address, request_id))
+
+        if seen:
+            return
+
+        # The request went through too many nodes
+        if not frame.forward():
+            return
+
+        # Re-broadcast request
+        self.network.send_message(Frame.FRAME_TYPES['routing_request'], b''.join([
+            frame.data,
+            self._hop(frame.rssi),
+        ]), frame.destination_address, forwarded=True, ttl=frame.ttl, hops=frame.hops)
+
+    def _add_candidate(self, origin: int, request_id: int, hops: list[tuple[int, int, int]]):
+        """ Keep the route when it is the best one for the request so far,
+            the first route starts the window after which it is answered
+        """
+        key = (origin, request_id)
+        cost = self.cost(hops)
+        route = [address for address, _, _ in hops]
+
+        if key not in self.candidates:
+            self.candidates[key] = [time(), cost, route]
+            asyncio.get_event_loop().create_task(self._answer(key))
             return
 
-        self.request_list[frame.destination_address] = time()
-        if frame.destination_address != self.network.address:
-            # Re-broadcast request
-            self.network.send_message(Frame.FRAME_TYPES['routing_request'], b''.join([
-                frame.data,
-                self.network.address.to_bytes(2, 'big'),
-                frame.rssi.to_bytes(1, 'big'),
-            ]), frame.destination_address)
+        candidate = self.candidates[key]
+        if candidate[2] is not None and cost < candidate[1]:
+            candidate[1] = cost
+            candidate[2] = route
+
+    async def _answer(self, key: tuple[int, int]):
+        """ Send the route response for the best route after the window """
+        await asyncio.sleep(self.window)
+
+        candidate = self.candidates.get(key)
+        if candidate is None or candidate[2] is None:
             return
 
-        # TODO: Make use of the RSSI for best route
-        # origin -> between nodes -> end node
-        route: list[bytes] = [frame.data[i:i+2]
-                              for i in range(0, len(frame.data), 3)]
-        route.append(self.network.address.to_bytes(2, 'big'))
-        # Rssi can be found on every third value, ignoring for now.
-        # rssi = int.from_bytes(frame.data[i+2:i+3], 'big', signed=True)
+        route = candidate[2]
+        candidate[2] = None
 
-        logger(f"Found a route: {route}", channel='routing')
+        if logger.enabled('routing'):
+            logger(f"Found a route: {route} with cost {candidate[1]}", channel='routing')
         self.network.send_message(
             Frame.FRAME_TYPES['routing_response'],
-            b''.join(route),
-            int.from_bytes(route[-2], 'big'),
+            b''.join([address.to_bytes(2, 'big') for address in route]),
+            route[-2],
         )
 
+    def _expire_pending(self):
+        """ Forget the requests that got no response in `self.timeout`, the next use requests again """
+        now = time()
+        with self.pending_lock:
+            for address in [address for address, requested in self.pending.items() if requested + self.timeout < now]:
+                del self.pending[address]
+                self.repairs.pop(address, None)
+
+    def _expire_candidates(self):
+        """ Forget the answered requests after `self.timeout` """
+        now = time()
+        for key in [key for key, (started, _, _) in self.candidates.items() if started + self.timeout < now]:
+            del self.candidates[key]
+
     def handle_routing_response(self, frame: Frame):
         """ Handles a routing response.
             Will pass along to the previous node according to the body of the
             frame and save where request for origin needs to go.
         """
         route = [frame.data[i:i+2] for i in range(0, len(frame.data), 2)]
-        self.routing_table[int.from_bytes(
-            route[-1], 'big')] = frame.source_address
+        destination = int.from_bytes(route[-1], 'big')
+        self.routes.put(destination, frame.source_address)
+        with self.pending_lock:
+            self.pending.pop(destination, None)
+            self.repairs.pop(destination, None)
+
+        # Send the frames that were waiting for this route
+        self._release(destination)
 
         if int.from_bytes(route[0], 'big') == self.network.address:
             logger(f"Response route: {route}", channel='routing')
             return
 
+        if not frame.forward():
+            return
+
         hop = int.from_bytes(
             route[route.index(self.network.address.to_bytes(2, 'big')) - 1], 'big')
         self.network.send_message(
-            Frame.FRAME_TYPES['routing_response'], frame.data, hop)
+            Frame.FRAME_TYPES['routing_response'], frame.data, hop, forwarded=True, ttl=frame.ttl, hops=frame.hops)
@@ -0,0 +1,57 @@
+import asyncio
+
+
+class PacketStream:
+    """
+        read the packets from a uart as soon as their bytes arrive.
+
+        a uart is a stream of bytes, two packets that arrive shortly after each
+        other end up in the same read. every packet is therefore send as:
+            - 1 byte: SYNC, the start of a packet
+            - 1 byte: length of the data
+            - the data
+        followed by `trailer` bytes the other side adds (the rssi byte of the
+        e220), those are returned with the data.
+
+        bytes before a SYNC are skipped. a packet that is not complete within
+        `timeout` seconds is dropped, so a lost byte does not shift every
+        packet after it.
+    """
+
+    SYNC = 0xa5
+    HEADER_SIZE = 2
+    MAX_SIZE = 0xff
+
+    def __init__(self, stream, trailer: int = 0, timeout: float = 1):
+        self.reader = asyncio.StreamReader(stream)
+        self.trailer = trailer
+        self.timeout = timeout
+
+        # metrics
+        self.skipped = 0
+        self.incomplete = 0
+
+    @staticmethod
+    def pack(data: bytes) -> bytes:
+        """ the data with the packet header in front """
+        if len(data) > PacketStream.MAX_SIZE:
+            raise ValueError(f'packet of {len(data)} bytes is too large')
+
+        return bytes([PacketStream.SYNC, len(data)]) + data
+
+    async def read(self) -> bytes:
+        """ wait for the next packet, returns its data and trailer """
+        while True:
+            start = await self.reader.readexactly(1)
+            if start[0] != self.SYNC:
+                self.skipped += 1
+                continue
+
+            try:
+                return await asyncio.wait_for(self._read_packet(), self.timeout)
+            except asyncio.TimeoutError:
+                self.incomplete += 1
+
+    async def _read_packet(self) -> bytes:
+        length = (await self.reader.readexactly(1))[0]
+        return await self.reader.readexactly(length + self.trailer)
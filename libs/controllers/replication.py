@@ -74,7 +74,7 @@ class ReplicationController:
             return
 
         # store the bid
-        self.bids[frame.source_address] = int.from_bytes(frame.data, 'big')  # decode the ttl to an int
+        self.bids[frame.source_address] = int.from_bytes(frame.data, 'big')  # decode the distance in hops to an int
 
         # start a timer to wait for other bids. the lenght of this timer is in config
         if not self.waiting_for_bids:
@@ -30,6 +30,9 @@
 
         
         logger.register_channel("channel_name") # register a new channel
+
+        if logger.enabled("channel_name"):      # skip building an expensive message
+            logger(f"message {value}", channel="channel_name")
         ```
 
         the logger will print the following:
@@ -74,6 +77,10 @@ class _Logger:
         """ Set the state of the channel """
         self.channels[name] = state
 
+    def enabled(self, name: str) -> bool:
+        """ check if the channel is enabled """
+        return self.channels.get(name, False)
+
     def __call__(self, *args, **kwargs):
         """ 
             Log a message to the console based on the channel. this will print the 
@@ -0,0 +1,122 @@
+"""
+    frames send over multiple hops between E220 network controllers, on a
+    computer. the radios are replaced by a medium that delivers every packet
+    to the nodes in range of the sender, with the rssi of that link.
+"""
+import sys
+import time
+import types
+
+# the modules of the board and the config of the node
+if 'machine' not in sys.modules:
+    machine = types.ModuleType('machine')
+    machine.UART = machine.Pin = object
+    sys.modules['machine'] = machine
+
+if 'utime' not in sys.modules:
+    utime = types.ModuleType('utime')
+    utime.__dict__.update(time.__dict__)
+    utime.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    sys.modules['utime'] = utime
+
+config = types.ModuleType('config')
+config.rssi_enabled = True
+sys.modules.setdefault('config', config)
+
+from libs.controllers.network.E220NetworkController import E220NetworkController  # noqa: E402
+from libs.external.ChannelLogger import logger  # noqa: E402
+
+
+class Medium:
+    """ delivers the packets to the nodes in range, (sender, receiver) -> rssi """
+
+    def __init__(self, links: dict[tuple[int, int], int]):
+        self.links = links
+        self.nodes: dict[int, E220NetworkController] = {}
+
+    def deliver(self, sender: int, address: int, packet: bytes):
+        for receiver, node in self.nodes.items():
+            rssi = self.links.get((sender, receiver))
+            if rssi is not None and address in (receiver, 0xffff):
+                # without the packet header, with the rssi byte of the e220
+                node.on_message(packet[2:] + bytes([rssi & 0xff]))
+
+    def run(self):
+        """ send the queued frames of every node until all queues are empty """
+        sending = True
+        while sending:
+            sending = False
+            for node in self.nodes.values():
+                frame = node.queue.get()
+                if frame is not None:
+                    node._send_message(frame)
+                    sending = True
+
+
+class Radio:
+    sub_packet = 64
+
+    def __init__(self, medium: Medium, address: int):
+        self.medium = medium
+        self.address = address.to_bytes(2, 'big')
+
+    def set_mode(self, mode):
+        pass
+
+    def get_settings(self):
+        pass
+
+    def save(self):
+        pass
+
+    def send(self, address: bytes, packet: bytes):
+        self.medium.deliver(int.from_bytes(self.address, 'big'), int.from_bytes(address, 'big'), packet)
+
+
+class StaticRoutes:
+    def __init__(self, hops: dict[int, int]):
+        self.hops = hops
+
+    def get_route(self, address: int, forwarding: bool = False) -> int:
+        return self.hops.get(address, address)
+
+
+def line(links: dict[tuple[int, int], int]) -> Medium:
+    """ the nodes 1 - 2 - 3, every link in both directions """
+    for channel in ('routing', 'send_message', 'recieved_message'):
+        logger.set_channel(channel, False)
+
+    medium = Medium({**links, **{(b, a): rssi for (a, b), rssi in links.items()}})
+    for address, hops in ((1, {3: 2}), (2, {}), (3, {1: 2})):
+        node = E220NetworkController(Radio(medium, address))
+        node.routing_controller = StaticRoutes(hops)
+        medium.nodes[address] = node
+
+    # the neighbours heard from each other
+    for (a, b), rssi in medium.links.items():
+        medium.nodes[b].links.update(a, rssi, 0)
+
+    return medium
+
+
+def test_fragments_over_mixed_link_strengths():
+    # a clean first link and a link at the edge of the range after it
+    medium = line({(1, 2): -50, (2, 3): -110})
+    assert medium.nodes[1].links.strength(2) < medium.nodes[2].links.strength(3)
+
+    received = []
+    medium.nodes[3].register_callback(9, received.append)
+
+    for size in (10, 100, 400):
+        data = (bytes(range(256)) * 2)[:size]
+        medium.nodes[1].send_message(9, data, 3)
+        medium.run()
+
+        assert received and received[-1].data == data, size
+        assert received[-1].source_address == 1
+
+        # forwarded once by node 2, also when the frame was fragmented
+        assert received[-1].hops == 1 and received[-1].distance == 2
+
+    assert len(received) == 3
+    assert medium.nodes[3].reassembler.buffers == {}